@@ -0,0 +1,105 @@
+"""Benchmark for the streaming DOCX reader against the python-docx paragraph walk it replaced.
+
+Builds large .docx fixtures (prose plus Cornell-style tables) with python-docx, then times
+both readers and records peak traced memory. Run from the repository root:
+
+    python benchmarks/bench_docx.py [--paragraphs 2000,20000] [--json]
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+from io import BytesIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("GEMINI_API_KEY", "benchmark")
+
+import docx  # noqa: E402
+
+from streamlit_app import iter_docx_blocks  # noqa: E402
+
+VOCABULARY = (
+    "the cell membrane controls transport while mitochondria release energy through "
+    "respiration and ribosomes assemble proteins from amino acids"
+).split()
+
+
+def build_fixture(paragraphs, table_every=25, seed=3):
+    """Returns .docx bytes with the given number of paragraphs and a 2-column table every table_every."""
+    rng = random.Random(seed)
+    document = docx.Document()
+    for index in range(paragraphs):
+        document.add_paragraph(" ".join(rng.choice(VOCABULARY) for _ in range(rng.randint(8, 40))))
+        if index % table_every == table_every - 1:
+            table = document.add_table(rows=6, cols=2)
+            table.cell(0, 0).text, table.cell(0, 1).text = "Cues", "Notes"
+            for row in range(1, 6):
+                table.cell(row, 0).text = f"Question {index}-{row}?"
+                table.cell(row, 1).text = " ".join(rng.choice(VOCABULARY) for _ in range(15))
+    buffer = BytesIO()
+    document.save(buffer)
+    return buffer.getvalue()
+
+
+def legacy_extract(data):
+    # The implementation iter_docx_blocks replaced: paragraphs only, tables dropped
+    doc = docx.Document(BytesIO(data))
+    return "\n".join([paragraph.text for paragraph in doc.paragraphs])
+
+
+def streaming_extract(data):
+    return "\n".join(iter_docx_blocks(BytesIO(data)))
+
+
+def measure(fn, data, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        text = fn(data)
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    fn(data)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"seconds": best, "peak_bytes": peak, "chars": len(text)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--paragraphs", default="2000,20000", help="comma-separated fixture sizes")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+
+    results = []
+    for paragraphs in [int(size) for size in args.paragraphs.split(",")]:
+        data = build_fixture(paragraphs)
+        legacy = measure(legacy_extract, data, args.repeat)
+        streaming = measure(streaming_extract, data, args.repeat)
+        results.append({
+            "paragraphs": paragraphs,
+            "fixture_bytes": len(data),
+            "legacy": legacy,
+            "streaming": streaming,
+            "speedup": legacy["seconds"] / streaming["seconds"],
+        })
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return 0
+
+    for result in results:
+        print(f"{result['paragraphs']} paragraphs ({result['fixture_bytes']} bytes)")
+        for name in ("legacy", "streaming"):
+            run = result[name]
+            print(f"  {name:10} {run['seconds']:.4f} s  peak {run['peak_bytes'] / 1e6:.1f} MB  {run['chars']} chars")
+        print(f"  speedup    {result['speedup']:.1f}x")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,141 @@
+"""Equivalence check and micro-benchmark for StreamingFormatter against the original
+regex-based process_response.
+
+Run from the repository root:
+
+    python benchmarks/bench_formatter.py [--json]
+"""
+import json
+import os
+import random
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("GEMINI_API_KEY", "benchmark")
+
+from streamlit_app import StreamingFormatter, process_response  # noqa: E402
+
+
+def legacy_process_response(text):
+    # The implementation StreamingFormatter replaced, kept verbatim as the reference
+    lines = text.split('\n')
+    processed_lines = []
+
+    for line in lines:
+        if re.match(r'^\d+\.', line.strip()):
+            processed_lines.append('\n' + line.strip())
+        elif line.strip().startswith('*') or line.strip().startswith('-'):
+            processed_lines.append('\n' + line.strip())
+        else:
+            processed_lines.append(line)
+
+    text = '\n'.join(processed_lines)
+    text = re.sub(r'\n\s*\n\s*\n', '\n\n', text)
+    text = re.sub(r'(\n[*-] .+?)(\n[^*\n-])', r'\1\n\2', text)
+
+    return text.strip()
+
+
+CORPUS = [
+    "",
+    "Hello! Mainframe AI speaking.",
+    "Here are the steps:\n1. Read the question\n2. Solve it\n3. Check the answer\nDone.",
+    "Key points:\n* Population pyramids show age structure\n* Rapid growth has a wide base\nIn summary, the shape tells the story.",
+    "- one\n- two\n\n\n\n- three\nafter list",
+    "  indented text\n   * indented bullet\n\t- tabbed bullet\n   10. numbered late\ntext",
+    "| Cues | Notes |\n|---|---|\n| What is site? | Physical characteristics |\n\n**Summary:** Site vs situation.",
+    "```python\nx = 1\n- not a bullet in code\n```\nTrailing text   \n\n\n",
+    "Windows line endings\r\n* item\r\nnext\r\n",
+    "**Bold**: definition\n- **In Other Words:** rephrase\n- **Examples:** a, b, c\n**Next**: definition",
+    "*emphasis* at start\n-dash without space\n*\n-\n1.\n",
+    "\n\n\n\nleading blank lines\n \n \n \ntrailing spaces    ",
+]
+
+FUZZ_ALPHABET = ['a', 'b', ' ', '\n', '\n', '*', '-', '1', '.', '\t', '\r', 'x ', '* ', '- ', '1. ', '\n\n\n']
+
+
+def fuzz_corpus(count, seed=12):
+    rng = random.Random(seed)
+    return [
+        ''.join(rng.choice(FUZZ_ALPHABET) for _ in range(rng.randint(0, 40)))
+        for _ in range(count)
+    ]
+
+
+def stream_format(text, chunk_size):
+    formatter = StreamingFormatter()
+    out = [formatter.feed(text[i:i + chunk_size]) for i in range(0, len(text), chunk_size)]
+    out.append(formatter.finish())
+    return ''.join(out)
+
+
+def check_equivalence(corpus):
+    failures = []
+    for text in corpus:
+        expected = legacy_process_response(text)
+        if process_response(text) != expected:
+            failures.append((text, "whole"))
+        for chunk_size in (1, 2, 3, 7, 64):
+            if stream_format(text, chunk_size) != expected:
+                failures.append((text, chunk_size))
+    return failures
+
+
+def synthetic_answer(words=2000, seed=7):
+    rng = random.Random(seed)
+    vocabulary = "the population density of urban areas depends on site and situation factors".split()
+    lines = []
+    while sum(len(line.split()) for line in lines) < words:
+        kind = rng.random()
+        sentence = ' '.join(rng.choice(vocabulary) for _ in range(rng.randint(6, 20)))
+        if kind < 0.3:
+            lines.append(f"* {sentence}")
+        elif kind < 0.45:
+            lines.append(f"{len(lines) + 1}. {sentence}")
+        elif kind < 0.55:
+            lines.append("")
+        else:
+            lines.append(sentence)
+    return '\n'.join(lines)
+
+
+def run_benchmarks(repeat=20):
+    text = synthetic_answer()
+    token_size = 20  # roughly what one streamed chunk carries
+    results = {
+        "whole_text_legacy_s": min(timeit.repeat(lambda: legacy_process_response(text), number=1, repeat=repeat)),
+        "whole_text_streaming_s": min(timeit.repeat(lambda: process_response(text), number=1, repeat=repeat)),
+        "chunked_streaming_s": min(timeit.repeat(lambda: stream_format(text, token_size), number=1, repeat=repeat)),
+    }
+
+    # What re-running the legacy formatter on every streamed chunk would cost
+    def legacy_rerender():
+        for end in range(token_size, len(text) + token_size, token_size):
+            legacy_process_response(text[:end])
+
+    results["chunked_legacy_rerender_s"] = min(timeit.repeat(legacy_rerender, number=1, repeat=3))
+    results["input_chars"] = len(text)
+    return results
+
+
+def main():
+    corpus = CORPUS + fuzz_corpus(2000)
+    failures = check_equivalence(corpus)
+    results = run_benchmarks()
+    results["equivalence_cases"] = len(corpus)
+    results["equivalence_failures"] = len(failures)
+
+    if "--json" in sys.argv:
+        print(json.dumps(results, indent=2))
+    else:
+        for text, chunking in failures[:10]:
+            print(f"MISMATCH (chunk size {chunking}): {text!r}")
+        for name, value in results.items():
+            print(f"{name:32} {value:.6f}" if isinstance(value, float) else f"{name:32} {value}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,111 @@
+"""Cold-start import report for streamlit_app.py, in the spirit of `python -X importtime`.
+
+Imports the app in a fresh interpreter with -X importtime and subtracts the modules
+that streamlit and google.generativeai load by themselves, so only the app's own
+import cost is reported. Fails if a lazily loaded extractor dependency shows up at
+import time or the app's own cost exceeds the budget.
+
+Run from the repository root:
+
+    python benchmarks/bench_import_time.py [--json] [--budget-ms 120]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The baseline repeats what streamlit does on the app's behalf: set_page_config(page_icon=...)
+# loads PIL (and numpy) to read the icon, and the first element drawn outside `streamlit run`
+# pays for a one-off stack inspection. Only what the app itself adds is counted.
+BASELINE_IMPORTS = (
+    "import streamlit, google.generativeai; "
+    "streamlit.set_page_config(page_title='Mainframe AI', page_icon='./favicon.ico', layout='wide'); "
+    "streamlit.empty()"
+)
+APP_IMPORTS = BASELINE_IMPORTS + "; import streamlit_app"
+
+# Extractor dependencies that must only be imported on first use
+LAZY_MODULES = ["pandas", "pytesseract", "speech_recognition", "PyPDF2", "docx", "PIL", "fitz"]
+
+
+def import_times(statement):
+    """Returns {module: (self_us, cumulative_us)} for everything the statement imports."""
+    env = dict(os.environ)
+    env.setdefault("GEMINI_API_KEY", "benchmark")
+    # The warm-up thread would import extractors in the background and skew the report
+    env["MAINFRAME_WARMUP_FORMATS"] = ""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        cwd=REPO_ROOT,
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr[-2000:])
+
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, module = line[len("import time:"):].split("|")
+        times[module.strip()] = (int(self_us), int(cumulative_us))
+    return times
+
+
+def build_report(runs=3):
+    # Take the fastest of a few runs for each module to smooth out disk cache noise
+    def fastest(statement):
+        merged = {}
+        for _ in range(runs):
+            for module, (self_us, cumulative_us) in import_times(statement).items():
+                if module not in merged or self_us < merged[module][0]:
+                    merged[module] = (self_us, cumulative_us)
+        return merged
+
+    baseline = fastest(BASELINE_IMPORTS)
+    app = fastest(APP_IMPORTS)
+    added = {module: times for module, times in app.items() if module not in baseline}
+    return {
+        "app_self_ms": sum(self_us for self_us, _ in added.values()) / 1000,
+        "baseline_ms": sum(self_us for self_us, _ in baseline.values()) / 1000,
+        "added_modules": len(added),
+        "slowest_added": sorted(
+            ({"module": module, "self_ms": self_us / 1000} for module, (self_us, _) in added.items()),
+            key=lambda entry: entry["self_ms"],
+            reverse=True,
+        )[:15],
+        "eager_lazy_modules": sorted(
+            module for module in added
+            if module.split(".")[0] in LAZY_MODULES
+        ),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument("--budget-ms", type=float, default=120.0, help="max import time added by the app")
+    args = parser.parse_args()
+
+    report = build_report()
+    report["budget_ms"] = args.budget_ms
+    failed = bool(report["eager_lazy_modules"]) or report["app_self_ms"] > args.budget_ms
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"app import time: {report['app_self_ms']:.1f} ms (budget {args.budget_ms:.0f} ms)")
+        print(f"streamlit + genai baseline: {report['baseline_ms']:.1f} ms")
+        for entry in report["slowest_added"]:
+            print(f"  {entry['self_ms']:8.2f} ms  {entry['module']}")
+        if report["eager_lazy_modules"]:
+            print("imported eagerly but should be lazy: " + ", ".join(report["eager_lazy_modules"]))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
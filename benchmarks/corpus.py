@@ -0,0 +1,223 @@
+"""Versioned fixture corpus for the pipeline benchmarks.
+
+Every fixture is generated from a fixed seed, and the PDFs are written by hand rather than
+through a PDF library. manifest.json records each fixture's hash, and the benchmark results
+carry it, so results from different corpora are never compared by accident. Bump
+CORPUS_VERSION whenever a fixture's recipe changes.
+
+    python benchmarks/corpus.py [--force]
+"""
+import argparse
+import array
+import hashlib
+import json
+import math
+import os
+import random
+import sys
+import wave
+import zlib
+from io import BytesIO
+
+CORPUS_VERSION = 1
+CORPUS_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".corpus")
+
+VOCABULARY = (
+    "population density urban rural site situation migration census pyramid growth rate "
+    "agriculture industry services demographic transition fertility mortality dependency"
+).split()
+
+PAGE_WIDTH, PAGE_HEIGHT = 612, 792
+
+
+def sentence(rng, words=12):
+    return " ".join(rng.choice(VOCABULARY) for _ in range(words)).capitalize() + "."
+
+
+def pdf_escape(text):
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def build_pdf(pages):
+    """Writes a minimal PDF. Each page is ("text", [lines]) or ("jpeg", (bytes, width, height))."""
+    objects = [None, None]  # catalog and page tree are filled in last
+    font_id = len(objects) + 1
+    objects.append(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+    page_ids = []
+
+    for kind, payload in pages:
+        resources = f"/Font << /F1 {font_id} 0 R >>"
+        if kind == "text":
+            commands = ["BT", "/F1 11 Tf", "14 TL", f"56 {PAGE_HEIGHT - 60} Td"]
+            commands += [f"({pdf_escape(line)}) '" for line in payload]
+            commands.append("ET")
+            content = "\n".join(commands).encode("latin-1")
+        else:
+            data, width, height = payload
+            objects.append(
+                f"<< /Type /XObject /Subtype /Image /Width {width} /Height {height} "
+                f"/ColorSpace /DeviceGray /BitsPerComponent 8 /Filter /DCTDecode /Length {len(data)} >>\n"
+                .encode("latin-1") + b"stream\n" + data + b"\nendstream"
+            )
+            resources += f" /XObject << /Im1 {len(objects)} 0 R >>"
+            content = f"q {PAGE_WIDTH} 0 0 {PAGE_HEIGHT} 0 0 cm /Im1 Do Q".encode("latin-1")
+
+        compressed = zlib.compress(content)
+        objects.append(
+            f"<< /Length {len(compressed)} /Filter /FlateDecode >>\n".encode("latin-1")
+            + b"stream\n" + compressed + b"\nendstream"
+        )
+        content_id = len(objects)
+        objects.append(
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {PAGE_WIDTH} {PAGE_HEIGHT}] "
+            f"/Resources << {resources} >> /Contents {content_id} 0 R >>".encode("latin-1")
+        )
+        page_ids.append(len(objects))
+
+    objects[0] = b"<< /Type /Catalog /Pages 2 0 R >>"
+    kids = " ".join(f"{page_id} 0 R" for page_id in page_ids)
+    objects[1] = f"<< /Type /Pages /Kids [{kids}] /Count {len(page_ids)} >>".encode("latin-1")
+
+    output = BytesIO()
+    output.write(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(output.tell())
+        output.write(f"{number} 0 obj\n".encode("latin-1") + body + b"\nendobj\n")
+    xref = output.tell()
+    output.write(f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode("latin-1"))
+    for offset in offsets:
+        output.write(f"{offset:010d} 00000 n \n".encode("latin-1"))
+    output.write(f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode("latin-1"))
+    return output.getvalue()
+
+
+def text_pdf(pages=30, seed=1):
+    # Running header, page number footer and hyphenated line breaks, like an exported textbook chapter
+    rng = random.Random(seed)
+    page_specs = []
+    for page in range(1, pages + 1):
+        lines = ["AP Human Geography | Unit 2: Population", ""]
+        for _ in range(40):
+            line = sentence(rng, rng.randint(8, 12))
+            if rng.random() < 0.1:
+                line = line[:-1] + " migra-"
+            lines.append(line)
+        lines += ["", f"Page {page} of {pages}"]
+        page_specs.append(("text", lines))
+    return build_pdf(page_specs)
+
+
+def page_image(seed, width=1275, height=1650):
+    """Renders a page of text to a grayscale PIL image, as a phone scan of a worksheet would look."""
+    from PIL import Image, ImageDraw
+
+    rng = random.Random(seed)
+    image = Image.new("L", (width, height), 255)
+    draw = ImageDraw.Draw(image)
+    for row in range(60, height - 60, 28):
+        draw.text((70, row), sentence(rng, 10), fill=20)
+    return image
+
+
+def scanned_pdf(pages=4, seed=2):
+    page_specs = []
+    for page in range(pages):
+        image = page_image(seed + page)
+        buffer = BytesIO()
+        image.save(buffer, format="JPEG", quality=80)
+        page_specs.append(("jpeg", (buffer.getvalue(), image.width, image.height)))
+    return build_pdf(page_specs)
+
+
+def scan_png(seed=3):
+    buffer = BytesIO()
+    page_image(seed).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def table_csv(rows=50000, seed=4):
+    rng = random.Random(seed)
+    lines = ["country,region,year,population,growth_rate,urban_share,notes"]
+    regions = ["Africa", "Asia", "Europe", "Americas", "Oceania"]
+    for row in range(rows):
+        lines.append(",".join([
+            f"Country {row % 190}",
+            rng.choice(regions),
+            str(1950 + row % 75),
+            str(rng.randint(10_000, 1_400_000_000)),
+            f"{rng.uniform(-1, 4):.2f}",
+            f"{rng.random():.3f}",
+            "" if rng.random() < 0.7 else sentence(rng, 6),
+        ]))
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+def speech_wav(seconds=30, sample_rate=16000, seed=5):
+    # Tone bursts separated by pauses stand in for phrases, so silence splitting has work to do
+    rng = random.Random(seed)
+    samples = array.array("h")
+    while len(samples) < seconds * sample_rate:
+        burst = int(rng.uniform(0.8, 3.0) * sample_rate)
+        frequency = rng.uniform(140, 320)
+        samples.extend(
+            int(9000 * math.sin(2 * math.pi * frequency * index / sample_rate) * (0.6 + 0.4 * rng.random()))
+            for index in range(burst)
+        )
+        samples.extend(int(rng.gauss(0, 60)) for _ in range(int(rng.uniform(0.2, 0.9) * sample_rate)))
+    del samples[seconds * sample_rate:]
+    if sys.byteorder == "big":
+        samples.byteswap()
+
+    buffer = BytesIO()
+    with wave.open(buffer, "wb") as output:
+        output.setnchannels(1)
+        output.setsampwidth(2)
+        output.setframerate(sample_rate)
+        output.writeframes(samples.tobytes())
+    return buffer.getvalue()
+
+
+FIXTURES = {
+    "text.pdf": text_pdf,
+    "scanned.pdf": scanned_pdf,
+    "scan.png": scan_png,
+    "table.csv": table_csv,
+    "speech.wav": speech_wav,
+}
+
+
+def build_corpus(force=False):
+    """Generates any missing fixtures and returns {name: path} plus the manifest."""
+    directory = os.path.join(CORPUS_ROOT, f"v{CORPUS_VERSION}")
+    os.makedirs(directory, exist_ok=True)
+    manifest_path = os.path.join(directory, "manifest.json")
+
+    paths = {}
+    manifest = {"version": CORPUS_VERSION, "files": {}}
+    for name, build in FIXTURES.items():
+        path = os.path.join(directory, name)
+        if force or not os.path.exists(path):
+            with open(path, "wb") as output:
+                output.write(build())
+        with open(path, "rb") as fixture:
+            data = fixture.read()
+        manifest["files"][name] = {"bytes": len(data), "sha256": hashlib.sha256(data).hexdigest()}
+        paths[name] = path
+
+    with open(manifest_path, "w") as output:
+        json.dump(manifest, output, indent=2)
+    return paths, manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate the benchmark fixture corpus")
+    parser.add_argument("--force", action="store_true", help="regenerate fixtures that already exist")
+    args = parser.parse_args()
+    _, manifest = build_corpus(force=args.force)
+    print(json.dumps(manifest, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,153 @@
+"""Offline stand-in for google.generativeai's GenerativeModel and ChatSession.
+
+Replies stream with a configurable time to first token and token rate, so the app's
+streaming, formatting and rendering paths can be timed without network access:
+
+    restore = fake_gemini.install(first_token_latency=0.2, tokens_per_second=200)
+    ...
+    restore()
+"""
+import time
+
+import google.generativeai as genai
+
+# Roughly how many characters one streamed chunk carries
+CHARS_PER_TOKEN = 4
+TOKENS_PER_CHUNK = 8
+
+DEFAULT_REPLY = "\n".join([
+    "Here is a summary of the material:",
+    "1. Cells are the basic unit of life.",
+    "2. Mitochondria release energy through respiration.",
+    "* Ribosomes assemble proteins from amino acids",
+    "* The membrane controls what enters and leaves the cell",
+    "In short, each organelle has a job that keeps the cell alive.",
+])
+
+
+def reply_text(tokens, seed_text=DEFAULT_REPLY):
+    """Returns a deterministic reply of about the given number of tokens."""
+    target = tokens * CHARS_PER_TOKEN
+    repeats = target // (len(seed_text) + 1) + 1
+    return ("\n".join([seed_text] * repeats))[:target]
+
+
+class FakeChunk:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeResponse:
+    """Iterable like a streamed GenerateContentResponse; .text blocks until the whole reply is out."""
+
+    def __init__(self, text, first_token_latency, tokens_per_second, on_complete=None):
+        self._text = text
+        self.first_token_latency = first_token_latency
+        self.tokens_per_second = tokens_per_second
+        self._on_complete = on_complete
+        self._done = False
+
+    def __iter__(self):
+        chunk_chars = TOKENS_PER_CHUNK * CHARS_PER_TOKEN
+        chunks = [self._text[start:start + chunk_chars] for start in range(0, len(self._text), chunk_chars)]
+        if self._done:
+            # Already streamed once; replay without waiting again
+            yield from (FakeChunk(chunk) for chunk in chunks)
+            return
+
+        time.sleep(self.first_token_latency)
+        delay = TOKENS_PER_CHUNK / self.tokens_per_second if self.tokens_per_second else 0.0
+        for index, chunk in enumerate(chunks):
+            if index:
+                time.sleep(delay)
+            yield FakeChunk(chunk)
+        self._done = True
+        if self._on_complete is not None:
+            self._on_complete(self._text)
+
+    @property
+    def text(self):
+        return "".join(chunk.text for chunk in self)
+
+    def simulated_seconds(self):
+        chunks = -(-len(self._text) // (TOKENS_PER_CHUNK * CHARS_PER_TOKEN))
+        per_chunk = TOKENS_PER_CHUNK / self.tokens_per_second if self.tokens_per_second else 0.0
+        return self.first_token_latency + max(0, chunks - 1) * per_chunk
+
+
+def to_parts(content):
+    items = content if isinstance(content, list) else [content]
+    parts = []
+    for item in items:
+        if isinstance(item, genai.protos.Part):
+            parts.append(item)
+        elif isinstance(item, dict):
+            parts.append(genai.protos.Part(inline_data=genai.protos.Blob(
+                mime_type=item['mime_type'], data=item['data']
+            )))
+        else:
+            parts.append(genai.protos.Part(text=str(item)))
+    return parts
+
+
+class FakeChatSession:
+    def __init__(self, model, history=None):
+        self.model = model
+        self.history = list(history or [])
+
+    def send_message(self, content, stream=False, **kwargs):
+        user = genai.protos.Content(role="user", parts=to_parts(content))
+
+        def record(text):
+            self.history.extend([user, genai.protos.Content(role="model", parts=[genai.protos.Part(text=text)])])
+
+        response = self.model.generate_content(content, stream=True, on_complete=record)
+        if not stream:
+            response.text
+        return response
+
+
+class FakeGenerativeModel:
+    def __init__(self, model_name=None, generation_config=None, system_instruction=None,
+                 first_token_latency=0.0, tokens_per_second=0.0, reply_tokens=400, **kwargs):
+        self.model_name = model_name
+        self.first_token_latency = first_token_latency
+        self.tokens_per_second = tokens_per_second
+        self.reply = reply_text(reply_tokens)
+        self.calls = 0
+
+    def generate_content(self, contents, stream=False, on_complete=None, **kwargs):
+        # generation_config, safety_settings etc. are accepted like the real model and ignored
+        self.calls += 1
+        response = FakeResponse(self.reply, self.first_token_latency, self.tokens_per_second, on_complete)
+        if not stream:
+            response.text
+        return response
+
+    def start_chat(self, history=None):
+        return FakeChatSession(self, history)
+
+
+def install(first_token_latency=0.0, tokens_per_second=0.0, reply_tokens=400):
+    """Routes genai.GenerativeModel to the fake and makes genai.configure a no-op.
+
+    Returns a function that restores the real ones.
+    """
+    original_model, original_configure = genai.GenerativeModel, genai.configure
+
+    def make_model(*args, **kwargs):
+        return FakeGenerativeModel(
+            *args,
+            first_token_latency=first_token_latency,
+            tokens_per_second=tokens_per_second,
+            reply_tokens=reply_tokens,
+            **kwargs,
+        )
+
+    genai.GenerativeModel = make_model
+    genai.configure = lambda **kwargs: None
+
+    def restore():
+        genai.GenerativeModel, genai.configure = original_model, original_configure
+
+    return restore
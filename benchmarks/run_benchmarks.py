@@ -0,0 +1,280 @@
+"""Offline benchmark suite for the hot paths of streamlit_app.py.
+
+Times extraction, response formatting, streaming and a full chat turn (driven through
+Streamlit's AppTest) against the fixture corpus in corpus.py and the fake Gemini backend in
+fake_gemini.py, and writes machine-readable results so commits can be compared:
+
+    python benchmarks/run_benchmarks.py --output before.json
+    python benchmarks/run_benchmarks.py --compare before.json [--threshold 0.15]
+
+--include-micro also runs bench_formatter.py, bench_docx.py and bench_import_time.py and
+folds their JSON output into the results.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from io import BytesIO
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, BENCHMARK_DIR)
+
+# Keep every run offline and free of state left over from earlier runs
+os.environ.setdefault("GEMINI_API_KEY", "benchmark")
+os.environ["MAINFRAME_FILE_BACKEND"] = "local"
+os.environ["MAINFRAME_RESPONSE_CACHE"] = "0"
+os.environ["MAINFRAME_WARMUP_FORMATS"] = ""
+os.environ["MAINFRAME_CACHE_DIR"] = tempfile.mkdtemp(prefix="mainframe_bench_")
+
+import corpus  # noqa: E402
+import fake_gemini  # noqa: E402
+
+MICRO_BENCHMARKS = ["bench_formatter.py", "bench_docx.py", "bench_import_time.py"]
+# Differences smaller than this are treated as noise when comparing runs
+NOISE_FLOOR_SECONDS = 0.002
+
+
+class RecordingPlaceholder:
+    """Stands in for st.empty(): counts repaints instead of rendering them."""
+
+    def __init__(self):
+        self.renders = 0
+
+    def markdown(self, body, unsafe_allow_html=False):
+        self.renders += 1
+
+
+class UploadedFixture(BytesIO):
+    """Quacks like a Streamlit UploadedFile for code that reads .name, .size and .getvalue()."""
+
+    def __init__(self, data, name):
+        super().__init__(data)
+        self.name = name
+        self.size = len(data)
+
+
+def timed(fn, repeat):
+    samples = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        samples.append(time.perf_counter() - start)
+    return samples, result
+
+
+def summarize(samples, **extra):
+    return {
+        "min_s": min(samples),
+        "median_s": statistics.median(samples),
+        "max_s": max(samples),
+        "repeat": len(samples),
+        **extra,
+    }
+
+
+def text_case(fn, repeat):
+    samples, text = timed(fn, repeat)
+    return summarize(samples, output_chars=len(text), error=text.startswith("Error "))
+
+
+def git_revision():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+        dirty = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"], cwd=REPO_ROOT, capture_output=True, text=True
+        ).stdout.strip()
+        return commit + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def extraction_cases(app, fixtures, repeat):
+    def read(name):
+        with open(fixtures[name], "rb") as fixture:
+            return fixture.read()
+
+    text_pdf, scanned_pdf, scan, table, speech = (
+        read(name) for name in ("text.pdf", "scanned.pdf", "scan.png", "table.csv", "speech.wav")
+    )
+    app.SPEECH_BACKENDS.setdefault("benchmark", lambda recognizer, audio: "benchmark transcript")
+
+    return {
+        "extract_pdf_text[text.pdf]": lambda: text_case(lambda: app.extract_pdf_text(BytesIO(text_pdf)), repeat),
+        "extract_pdf_text[scanned.pdf]": lambda: text_case(lambda: app.extract_pdf_text(BytesIO(scanned_pdf)), repeat),
+        "extract_image_text[scan.png]": lambda: text_case(lambda: app.extract_image_text(BytesIO(scan)), repeat),
+        "process_structured_data[table.csv]": lambda: text_case(
+            lambda: app.process_structured_data(BytesIO(table), "text/csv"), repeat
+        ),
+        "convert_audio_to_text[speech.wav]": lambda: text_case(
+            lambda: app.convert_audio_to_text(speech, backend="benchmark"), repeat
+        ),
+    }
+
+
+def response_cases(app, args, repeat):
+    answer = fake_gemini.reply_text(args.reply_tokens)
+
+    def stream_once():
+        placeholder = RecordingPlaceholder()
+        response = fake_gemini.FakeResponse(answer, args.first_token_latency, args.tokens_per_second)
+        start = time.perf_counter()
+        app.handle_chat_response(response, placeholder)
+        elapsed = time.perf_counter() - start
+        return elapsed, elapsed - response.simulated_seconds(), placeholder.renders
+
+    def handle_chat_response_case():
+        runs = [stream_once() for _ in range(repeat)]
+        return summarize(
+            [run[0] for run in runs],
+            overhead_median_s=statistics.median(run[1] for run in runs),
+            renders=runs[-1][2],
+            output_chars=len(answer),
+        )
+
+    return {
+        "process_response[reply]": lambda: text_case(lambda: app.process_response(answer), repeat),
+        "handle_chat_response[fake stream]": handle_chat_response_case,
+    }
+
+
+def main_turn_case(fixtures, turns):
+    from streamlit.testing.v1 import AppTest
+
+    with open(fixtures["text.pdf"], "rb") as fixture:
+        attachment = UploadedFixture(fixture.read(), "text.pdf")
+
+    app_test = AppTest.from_file(os.path.join(REPO_ROOT, "streamlit_app.py"), default_timeout=120)
+    app_test.secrets["PASSWORD"] = "benchmark"
+    app_test.secrets["OTHERPW"] = "benchmark"
+    app_test.session_state["password_correct"] = True
+    app_test.session_state["uploaded_files"] = [attachment]
+
+    start = time.perf_counter()
+    app_test.run()
+    first_render = time.perf_counter() - start
+    if app_test.exception:
+        raise RuntimeError(app_test.exception[0].message)
+
+    samples = []
+    for turn in range(turns):
+        start = time.perf_counter()
+        app_test.chat_input[0].set_value(f"Summarize the attached chapter, part {turn + 1}").run()
+        samples.append(time.perf_counter() - start)
+        if app_test.exception:
+            raise RuntimeError(app_test.exception[0].message)
+
+    # The first turn pays for extraction; later turns hit the extraction cache
+    return summarize(samples, first_render_s=first_render, first_turn_s=samples[0])
+
+
+def run_micro_benchmarks():
+    results = {}
+    for script in MICRO_BENCHMARKS:
+        completed = subprocess.run(
+            [sys.executable, os.path.join(BENCHMARK_DIR, script), "--json"],
+            cwd=REPO_ROOT, capture_output=True, text=True
+        )
+        try:
+            results[script] = json.loads(completed.stdout)
+        except ValueError:
+            results[script] = {"error": (completed.stderr or completed.stdout).strip()[-500:]}
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Prints per-case median changes; returns the names of cases that got slower than threshold."""
+    if baseline["meta"].get("corpus") != results["meta"].get("corpus"):
+        print("warning: baseline was measured on a different fixture corpus")
+
+    regressions = []
+    for name, result in results["cases"].items():
+        before = baseline["cases"].get(name, {})
+        if "median_s" not in result or "median_s" not in before:
+            continue
+        change = result["median_s"] / before["median_s"] - 1 if before["median_s"] else 0.0
+        slower = change > threshold and result["median_s"] - before["median_s"] > NOISE_FLOOR_SECONDS
+        if slower:
+            regressions.append(name)
+        print(f"{name:42} {before['median_s']:.4f} -> {result['median_s']:.4f} s ({change:+.1%}){'  REGRESSION' if slower else ''}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark suite for streamlit_app.py")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--turns", type=int, default=3, help="chat turns driven through AppTest")
+    parser.add_argument("--first-token-latency", type=float, default=0.3)
+    parser.add_argument("--tokens-per-second", type=float, default=250.0)
+    parser.add_argument("--reply-tokens", type=int, default=600)
+    parser.add_argument("--skip-app", action="store_true", help="skip the AppTest chat turn")
+    parser.add_argument("--include-micro", action="store_true", help="also run the standalone benchmarks")
+    parser.add_argument("--output", help="write results JSON here instead of stdout")
+    parser.add_argument("--compare", help="baseline results JSON to compare against")
+    parser.add_argument("--threshold", type=float, default=0.15, help="relative slowdown counted as a regression")
+    args = parser.parse_args()
+
+    fixtures, manifest = corpus.build_corpus()
+    restore = fake_gemini.install(args.first_token_latency, args.tokens_per_second, args.reply_tokens)
+    try:
+        import streamlit_app as app
+
+        cases = {}
+        cases.update(extraction_cases(app, fixtures, args.repeat))
+        cases.update(response_cases(app, args, args.repeat))
+        if not args.skip_app:
+            cases["main_turn[text.pdf]"] = lambda: main_turn_case(fixtures, args.turns)
+
+        results = {}
+        for name, run in cases.items():
+            try:
+                results[name] = run()
+            except Exception as e:
+                results[name] = {"error": f"{type(e).__name__}: {e}"}
+            print(f"{name:42} {results[name].get('median_s', float('nan')):.4f} s", file=sys.stderr)
+    finally:
+        restore()
+
+    output = {
+        "meta": {
+            "commit": git_revision(),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "corpus": manifest,
+            "fake_model": {
+                "first_token_latency": args.first_token_latency,
+                "tokens_per_second": args.tokens_per_second,
+                "reply_tokens": args.reply_tokens,
+            },
+        },
+        "cases": results,
+    }
+    if args.include_micro:
+        output["micro"] = run_micro_benchmarks()
+
+    if args.output:
+        with open(args.output, "w") as results_file:
+            json.dump(output, results_file, indent=2)
+    else:
+        print(json.dumps(output, indent=2))
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            regressions = compare(output, json.load(baseline_file), args.threshold)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,170 @@
+"""Extraction helpers that run in the extraction process pool.
+
+They live outside streamlit_app.py because Streamlit runs the app as a script, so
+functions defined there cannot be pickled by reference into worker processes.
+Only Pillow, PyMuPDF and pytesseract are imported, and only when first used.
+
+Functions submitted to the pool never raise. Some library exceptions (e.g. pytesseract's
+TesseractNotFoundError) can't be unpickled in the parent, and a result that fails to
+unpickle breaks the whole pool, so failures come back as "Error ..." strings instead.
+"""
+import os
+from io import BytesIO
+
+# Scanner metadata in this range is trusted; phone cameras usually report a meaningless 72
+TRUSTED_DPI_RANGE = (100, 1200)
+OCR_TARGET_DPI = 300
+OCR_MIN_EDGE = 1000
+OCR_MAX_EDGE = 3500
+
+
+def open_pdf(source):
+    """Opens a PDF from a file path or from bytes.
+
+    The pool is handed a path to a shared temporary copy, so a large PDF is written once
+    instead of being pickled into every task.
+    """
+    import fitz
+
+    if isinstance(source, str):
+        return fitz.open(source, filetype="pdf")
+    return fitz.open(stream=source, filetype="pdf")
+
+
+def extract_pdf_page_texts(source, page_numbers):
+    """Returns [(page_number, text)], or an "Error ..." string."""
+    try:
+        pdf_document = open_pdf(source)
+        try:
+            return [(page_num, pdf_document[page_num].get_text()) for page_num in page_numbers]
+        finally:
+            pdf_document.close()
+    except Exception as e:
+        return f"Error extracting PDF pages: {e}"
+
+
+def ocr_pdf_pages(source, page_numbers, dpi=OCR_TARGET_DPI):
+    """Renders and OCRs a range of scanned PDF pages, for pages without a usable text layer.
+
+    Returns [(page_number, text)], where text is an "Error ..." string for pages that failed.
+    """
+    try:
+        pdf_document = open_pdf(source)
+    except Exception as e:
+        return [(page_num, f"Error opening PDF: {e}") for page_num in page_numbers]
+    try:
+        return [(page_num, ocr_pdf_page(pdf_document, page_num, dpi)) for page_num in page_numbers]
+    finally:
+        pdf_document.close()
+
+
+def ocr_pdf_page(pdf_document, page_num, dpi=OCR_TARGET_DPI):
+    try:
+        from PIL import Image
+
+        pixmap = pdf_document[page_num].get_pixmap(dpi=dpi)
+        image = Image.open(BytesIO(pixmap.tobytes("png")))
+    except Exception as e:
+        return f"Error rendering PDF page: {e}"
+    return ocr_tile(encode_tile(binarize(image)))
+
+
+def normalize_resolution(image):
+    from PIL import Image
+
+    dpi = image.info.get("dpi")
+    scale = 1.0
+    if dpi and TRUSTED_DPI_RANGE[0] <= dpi[0] <= TRUSTED_DPI_RANGE[1]:
+        scale = OCR_TARGET_DPI / float(dpi[0])
+    elif min(image.size) < OCR_MIN_EDGE:
+        scale = OCR_MIN_EDGE / float(min(image.size))
+
+    longest = max(image.size) * scale
+    if longest > OCR_MAX_EDGE:
+        scale *= OCR_MAX_EDGE / longest
+
+    if abs(scale - 1.0) < 0.05:
+        return image
+    size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+    return image.resize(size, Image.LANCZOS)
+
+
+def otsu_threshold(histogram):
+    total = sum(histogram)
+    weighted_total = sum(i * count for i, count in enumerate(histogram))
+    background_weight = 0
+    background_sum = 0
+    best_threshold, best_variance = 127, -1.0
+    for i, count in enumerate(histogram):
+        background_weight += count
+        if background_weight == 0:
+            continue
+        foreground_weight = total - background_weight
+        if foreground_weight == 0:
+            break
+        background_sum += i * count
+        background_mean = background_sum / background_weight
+        foreground_mean = (weighted_total - background_sum) / foreground_weight
+        variance = background_weight * foreground_weight * (background_mean - foreground_mean) ** 2
+        if variance > best_variance:
+            best_threshold, best_variance = i, variance
+    return best_threshold
+
+
+def binarize(image):
+    from PIL import ImageOps
+
+    gray = ImageOps.autocontrast(ImageOps.grayscale(image))
+    threshold = otsu_threshold(gray.histogram())
+    return gray.point(lambda value: 255 if value > threshold else 0)
+
+
+def split_into_tiles(image, tile_height, overlap):
+    """Horizontal bands top to bottom, so concatenating their text keeps reading order."""
+    if image.height <= tile_height:
+        return [image]
+    tiles = []
+    top = 0
+    while top < image.height:
+        bottom = min(top + tile_height, image.height)
+        tiles.append(image.crop((0, top, image.width, bottom)))
+        if bottom == image.height:
+            break
+        top = bottom - overlap
+    return tiles
+
+
+def encode_tile(image):
+    buffer = BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def ocr_tile(png_bytes, tesseract_config=""):
+    """Returns the tile's text, or an "Error ..." string."""
+    # Tesseract's own threading only oversubscribes the cores once tiles run in parallel
+    os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+    try:
+        import pytesseract
+        from PIL import Image
+
+        return pytesseract.image_to_string(Image.open(BytesIO(png_bytes)), config=tesseract_config)
+    except Exception as e:
+        return f"Error running OCR: {e}"
+
+
+def merge_tile_texts(tile_texts):
+    """Joins tile text in order, dropping lines repeated because tiles overlap."""
+    merged = []
+    for text in tile_texts:
+        lines = text.rstrip("\n").split("\n")
+        overlap = 0
+        max_overlap = min(len(lines), len(merged))
+        for size in range(max_overlap, 0, -1):
+            tail = [line.strip() for line in merged[-size:]]
+            head = [line.strip() for line in lines[:size]]
+            if tail == head and any(tail):
+                overlap = size
+                break
+        merged.extend(lines[overlap:])
+    return "\n".join(merged)
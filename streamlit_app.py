@@ -1,22 +1,78 @@
 import streamlit as st
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
 import time
 import re
 import os
 import mimetypes
 import tempfile
-import speech_recognition as sr
 import hashlib
-from PyPDF2 import PdfReader
-from docx import Document
-import pytesseract
-from PIL import Image
-import pandas as pd
+import importlib
 import json
-import xml.etree.ElementTree as ET
 from io import BytesIO
 import base64
-from datetime import datetime, timedelta
+import zipfile
+import threading
+import logging
+import unicodedata
+import random
+import math
+import uuid
+import sys
+import multiprocessing
+from array import array
+from collections import Counter, OrderedDict, deque
+from contextlib import ExitStack, contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta, timezone
+import extraction_workers
+
+logger = logging.getLogger("mainframe_ai")
+
+# Extractor dependencies are only imported the first time a format that needs them is used,
+# so sessions that only type text never pay for pandas, Pillow, Tesseract or speech recognition.
+FORMAT_MODULES = {
+    "pdf": ["fitz", "PyPDF2"],
+    "docx": ["lxml.etree"],
+    "image": ["PIL.Image", "PIL.ImageOps", "PIL.features", "pytesseract"],
+    "structured": ["pandas", "openpyxl", "ijson", "xml.etree.ElementTree"],
+    "audio": ["speech_recognition"],
+}
+# Modules that may be missing; everything else in FORMAT_MODULES is required
+OPTIONAL_MODULES = {"fitz", "ijson"}
+# Formats imported in the background when the server process starts, e.g. "pdf,image"
+WARMUP_FORMATS = [fmt.strip() for fmt in os.getenv("MAINFRAME_WARMUP_FORMATS", "pdf,image").split(",") if fmt.strip()]
+
+def lazy_import(name):
+    return importlib.import_module(name)
+
+def optional_import(name):
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        return None
+
+def warm_up_formats(formats):
+    timings = {}
+    for fmt in formats:
+        start = time.perf_counter()
+        for name in FORMAT_MODULES.get(fmt, []):
+            if name in OPTIONAL_MODULES:
+                optional_import(name)
+            else:
+                lazy_import(name)
+        timings[fmt] = time.perf_counter() - start
+    logger.info("Extractor warm-up import times: %s", timings)
+    return timings
+
+@st.cache_resource
+def start_extractor_warmup():
+    # Runs once per server process, off the script thread so the first page render isn't delayed
+    thread = threading.Thread(target=warm_up_formats, args=(WARMUP_FORMATS,), daemon=True)
+    thread.start()
+    return thread
 
 # Check for password in session state and persistent login
 def get_persistent_login():
@@ -100,7 +156,17 @@ def check_password():
     
     def password_entered():
         """Checks whether a password entered by the user is correct."""
-        if st.session_state["password"] == st.secrets["PASSWORD"]:
+        # Optional; unlocks the diagnostics panel for maintainers
+        admin_password = st.secrets.get("ADMIN_PASSWORD")
+        if admin_password in (st.secrets["PASSWORD"], st.secrets["OTHERPW"]):
+            # Otherwise every student who logs in would get the diagnostics panel
+            logger.warning("ADMIN_PASSWORD matches a shared password; admin access is disabled")
+            admin_password = None
+        if admin_password and st.session_state["password"] == admin_password:
+            st.session_state["password_correct"] = True
+            st.session_state["is_admin"] = True
+            del st.session_state["password"]  # Don't store the password
+        elif st.session_state["password"] == st.secrets["PASSWORD"]:
             st.session_state["password_correct"] = True
             del st.session_state["password"]  # Don't store the password
         elif st.session_state["password"] == st.secrets["OTHERPW"]:
@@ -302,7 +368,13 @@ GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 if not GEMINI_API_KEY:
     raise ValueError("Missing GEMINI_API_KEY environment variable")
 
-genai.configure(api_key=GEMINI_API_KEY)
+@st.cache_resource
+def configure_gemini():
+    # Configure once per process: genai.configure() discards its cached clients, so calling
+    # it on every rerun would throw away the open gRPC channel each time.
+    genai.configure(api_key=GEMINI_API_KEY)
+
+configure_gemini()
 
 # Page configuration
 st.set_page_config(
@@ -311,6 +383,8 @@ st.set_page_config(
     layout="wide"
 )
 
+start_extractor_warmup()
+
 # Custom CSS
 st.markdown("""
 <style>
@@ -451,6 +525,12 @@ generation_config = {
     "response_mime_type": "text/plain",
 }
 
+# Streaming render throttle: repaint at most every interval unless enough new text arrived
+STREAM_RENDER_INTERVAL = 0.05
+STREAM_RENDER_MIN_CHARS = 400
+
+CHAT_MODEL_NAME = "gemini-1.5-flash"
+
 SYSTEM_INSTRUCTION = """
 Name: Your name is Mainframe AI.
 Technology: You are powered by Google Gemini.
@@ -543,72 +623,1356 @@ PREBUILT_COMMANDS = {
     # Add more as needed
 }
 
-def extract_pdf_text(file):
+# Commands whose long inputs are split into chunks (map) and merged afterwards (reduce).
+# A reduce prompt of None means the partial results are simply joined in order.
+MAP_REDUCE_COMMANDS = {
+    "/summarize": {
+        "map_prompt": "Summarize this part of a longer set of notes or article into key points. Keep important concepts, facts and key definitions.",
+        "reduce_prompt": "The following are summaries of consecutive parts of one set of notes or article. Merge them into key points and a brief 1-2 paragraph summary. Highlight the most important concepts and facts, focus on key definitions. Make sure it's in paragraph format.",
+    },
+    "/litanalysis": {
+        "map_prompt": "Analyze this part of a longer piece of literature. Note characters, themes, main ideas, events and symbolism that appear in it.",
+        "reduce_prompt": "The following are analyses of consecutive parts of one piece of literature. Combine them into detailed, comprehensive summaries and insights on characters, themes, main ideas or various sections, and symbolism used, for a high school classroom.",
+    },
+    "/cornellformat": {
+        "map_prompt": "Extract the cues (questions) and the notes that answer them from this part of a longer set of notes, as Cues | Notes table rows.",
+        "reduce_prompt": "The following are Cues | Notes rows taken from consecutive parts of one set of notes. Format them into a Cornell Notes tabular format. First, before the table, should be the title. Then, a table with the header Cues | Notes, merging duplicate cues. After the table, type Summary: (in bold) and then a comprehensive, detailed summary of the notes with all necessary information while keeping it concise.",
+    },
+    "/translation": {
+        "map_prompt": "Translate this part of a longer text to the language requested in the student's instructions. Output only the translation.",
+        "reduce_prompt": None,
+    },
+}
+# Inputs longer than this (in characters) go through map-reduce for the commands above
+MAP_REDUCE_THRESHOLD_CHARS = 30000
+MAP_REDUCE_CHUNK_CHARS = 12000
+MAP_REDUCE_CONCURRENCY = 4
+# Leading part of the typed prompt repeated with every chunk so e.g. the target language isn't lost
+MAP_REDUCE_INSTRUCTION_CHARS = 500
+
+# Bump an extractor's version whenever its output changes so stale cache entries are ignored
+EXTRACTOR_VERSIONS = {
+    "pdf": 5,
+    "docx": 5,
+    "image": 2,
+    "structured": 5,
+}
+
+EXTRACTION_CACHE_DIR = os.getenv(
+    "MAINFRAME_CACHE_DIR",
+    os.path.join(tempfile.gettempdir(), "mainframe_ai_cache", "extraction")
+)
+EXTRACTION_CACHE_MAX_MEMORY_ENTRIES = 256
+EXTRACTION_CACHE_MAX_MEMORY_BYTES = 64 * 1024 * 1024
+EXTRACTION_CACHE_MAX_DISK_BYTES = 512 * 1024 * 1024
+
+class ExtractionCache:
+    """Two-tier cache of extracted text: a bounded in-memory LRU in front of a size-capped directory."""
+
+    def __init__(self, directory, max_memory_entries, max_memory_bytes, max_disk_bytes):
+        self.directory = directory
+        self.max_memory_entries = max_memory_entries
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+        os.makedirs(directory, exist_ok=True)
+        self._disk_bytes = sum(size for _, _, size in self._disk_entries())
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.txt")
+
+    def _disk_entries(self):
+        entries = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, path, stat.st_size))
+        return entries
+
+    def _remember(self, key, text):
+        size = len(text.encode('utf-8'))
+        if size > self.max_memory_bytes:
+            return
+        if key in self._memory:
+            self._memory_bytes -= self._memory.pop(key)[1]
+        self._memory[key] = (text, size)
+        self._memory_bytes += size
+        while len(self._memory) > self.max_memory_entries or self._memory_bytes > self.max_memory_bytes:
+            _, (_, evicted_size) = self._memory.popitem(last=False)
+            self._memory_bytes -= evicted_size
+
+    def get(self, key):
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.stats["memory_hits"] += 1
+                return self._memory[key][0]
+
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                text = f.read()
+            # Touch so disk eviction approximates least-recently-used
+            os.utime(path, None)
+        except OSError:
+            with self._lock:
+                self.stats["misses"] += 1
+            return None
+
+        with self._lock:
+            self.stats["disk_hits"] += 1
+            self._remember(key, text)
+        return text
+
+    def put(self, key, text):
+        with self._lock:
+            self._remember(key, text)
+
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(text)
+        except OSError:
+            return
+
+        with self._lock:
+            # Two sessions can miss on the same file at once; the second write replaces the first,
+            # so only the difference in size is added
+            try:
+                replaced_bytes = os.stat(path).st_size
+            except OSError:
+                replaced_bytes = 0
+            try:
+                os.replace(tmp_path, path)
+            except OSError:
+                return
+            self._disk_bytes += len(text.encode('utf-8')) - replaced_bytes
+            if self._disk_bytes > self.max_disk_bytes:
+                self._evict_disk()
+
+    def _evict_disk(self):
+        # Drop oldest files until we are comfortably under the cap
+        entries = sorted(self._disk_entries())
+        total = sum(size for _, _, size in entries)
+        target = self.max_disk_bytes * 0.9
+        for _, path, size in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                continue
+        self._disk_bytes = total
+
+@st.cache_resource
+def get_extraction_cache():
+    # Shared by every session in this server process
+    return ExtractionCache(
+        EXTRACTION_CACHE_DIR,
+        EXTRACTION_CACHE_MAX_MEMORY_ENTRIES,
+        EXTRACTION_CACHE_MAX_MEMORY_BYTES,
+        EXTRACTION_CACHE_MAX_DISK_BYTES,
+    )
+
+def extraction_cache_key(data, extractor, params=""):
+    content_hash = hashlib.sha256(data).hexdigest()
+    key_source = f"{extractor}:v{EXTRACTOR_VERSIONS[extractor]}:{params}:{content_hash}"
+    return hashlib.sha256(key_source.encode('utf-8')).hexdigest()
+
+def cached_extract(data, extractor, extract_fn, *args, params="", cache=None):
+    # Pass cache when calling from a worker thread
+    cache = cache or get_extraction_cache()
+    key = extraction_cache_key(data, extractor, params)
+    
+    content = cache.get(key)
+    if content is not None:
+        return content
+    
+    content = extract_fn(BytesIO(data), *args)
+    # Extractors report failures as text; don't let a transient error stick in the cache
+    if content and not content.startswith("Error "):
+        cache.put(key, content)
+    return content
+
+# Where attachments are uploaded: "gemini" uses the Files API, "local" is an offline stand-in
+FILE_BACKEND = os.getenv("MAINFRAME_FILE_BACKEND", "gemini")
+# Re-upload a little before the server-side expiry so a turn never references a dead handle
+FILE_HANDLE_EXPIRY_MARGIN = timedelta(hours=1)
+FILE_PROCESSING_TIMEOUT = 120
+
+class FileProcessingError(Exception):
+    """An upload reached the Files API but the file never became usable."""
+
+class GeminiFileStore:
+    def upload(self, data, mime_type, display_name):
+        uploaded = genai.upload_file(BytesIO(data), mime_type=mime_type, display_name=display_name)
+        
+        # Video and audio are processed server-side before they can be referenced
+        deadline = time.monotonic() + FILE_PROCESSING_TIMEOUT
+        while uploaded.state.name == "PROCESSING":
+            if time.monotonic() > deadline:
+                raise FileProcessingError(f"Timed out waiting for {display_name} to finish processing")
+            time.sleep(1)
+            uploaded = genai.get_file(uploaded.name)
+        if uploaded.state.name == "FAILED":
+            raise FileProcessingError(f"Upload of {display_name} failed during processing")
+        
+        return {
+            "name": uploaded.name,
+            "uri": uploaded.uri,
+            "mime_type": uploaded.mime_type or mime_type,
+            "expires_at": uploaded.expiration_time,
+        }
+
+class LocalFileStore:
+    """Offline stand-in for the Files API; keeps blobs in memory and hands back file URIs."""
+
+    lifetime = timedelta(hours=48)
+
+    def __init__(self):
+        self.blobs = {}
+        self.upload_count = 0
+
+    def upload(self, data, mime_type, display_name):
+        self.upload_count += 1
+        name = f"files/local-{self.upload_count}"
+        self.blobs[name] = data
+        return {
+            "name": name,
+            "uri": f"local://{name}",
+            "mime_type": mime_type,
+            "expires_at": datetime.now(timezone.utc) + self.lifetime,
+        }
+
+class FileRegistry:
+    """Uploads each distinct blob once and reuses its handle until shortly before it expires."""
+
+    def __init__(self, store):
+        self.store = store
+        self._handles = {}
+        self._lock = threading.Lock()
+        self._upload_locks = {}
+
+    def _is_fresh(self, handle):
+        return handle["expires_at"] - FILE_HANDLE_EXPIRY_MARGIN > datetime.now(timezone.utc)
+
+    def get_handle(self, data, mime_type, display_name):
+        key = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            handle = self._handles.get(key)
+            if handle and self._is_fresh(handle):
+                return handle
+            upload_lock = self._upload_locks.setdefault(key, threading.Lock())
+        
+        # Serialize uploads of the same blob so concurrent sessions don't upload it twice
+        with upload_lock:
+            with self._lock:
+                handle = self._handles.get(key)
+                if handle and self._is_fresh(handle):
+                    return handle
+            handle = self.store.upload(data, mime_type, display_name)
+            with self._lock:
+                self._handles[key] = handle
+            return handle
+
+@st.cache_resource
+def get_file_registry():
+    store = LocalFileStore() if FILE_BACKEND == "local" else GeminiFileStore()
+    return FileRegistry(store)
+
+def file_handle_part(handle):
+    return genai.protos.Part(
+        file_data=genai.protos.FileData(mime_type=handle["mime_type"], file_uri=handle["uri"])
+    )
+
+def prepare_file_part(data, mime_type, display_name, registry=None):
     try:
-        # Try using PyMuPDF (fitz) first for better PDF extraction
+        # Worker threads have no Streamlit context, so they pass the registry in
+        registry = registry or get_file_registry()
+        handle = registry.get_handle(data, mime_type, display_name)
+        return file_handle_part(handle)
+    except FileProcessingError:
+        # The file reached the server and is unusable there; inline bytes wouldn't fare better
+        raise
+    except Exception as e:
+        # Fall back to sending the bytes inline if the upload endpoint is unavailable
+        logger.warning("Upload of %s failed, sending it inline: %s", display_name, e)
+        return {'mime_type': mime_type, 'data': data}
+
+# Photos are downscaled and re-encoded before upload unless the user asks to send originals
+IMAGE_MAX_EDGE = int(os.getenv("MAINFRAME_IMAGE_MAX_EDGE", 1600))
+IMAGE_TARGET_BYTES = int(os.getenv("MAINFRAME_IMAGE_TARGET_BYTES", 300 * 1024))
+IMAGE_QUALITY_RANGE = (40, 90)
+IMAGE_QUALITY_STEP = 5
+IMAGE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+# Image.info keys that carry EXIF (including GPS), XMP or free-text metadata
+IMAGE_METADATA_KEYS = ("exif", "xmp", "XML:com.adobe.xmp", "photoshop", "iptc", "comment")
+
+class CompressedImageCache:
+    """LRU of compress_image results keyed by content hash, bounded by total bytes."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= len(previous[0])
+            self._entries[key] = entry
+            self._bytes += len(entry[0])
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted[0])
+
+@st.cache_resource
+def get_compressed_image_cache():
+    return CompressedImageCache(IMAGE_CACHE_MAX_BYTES)
+
+def has_image_metadata(image):
+    if any(key in image.info for key in IMAGE_METADATA_KEYS):
+        return True
+    # PNG tEXt/iTXt chunks
+    return bool(getattr(image, "text", None))
+
+def strip_animation_metadata(image):
+    # Re-saves every frame in the original format; the metadata keys are dropped so save() can't copy them
+    for key in IMAGE_METADATA_KEYS:
+        image.info.pop(key, None)
+    buffer = BytesIO()
+    image.save(buffer, format=image.format, save_all=True)
+    return buffer.getvalue()
+
+def encode_image(image, quality):
+    features = lazy_import("PIL.features")
+    buffer = BytesIO()
+    if features.check("webp"):
+        image.save(buffer, format="WEBP", quality=quality, method=4)
+        return buffer.getvalue(), 'image/webp'
+    image.convert("RGB").save(buffer, format="JPEG", quality=quality, optimize=True)
+    return buffer.getvalue(), 'image/jpeg'
+
+def compress_image(data, mime_type, cache=None):
+    """Downscales, strips metadata and re-encodes an image near IMAGE_TARGET_BYTES.
+
+    Returns (data, mime_type). The original is returned when it is already smaller and has no
+    metadata to strip. Results are cached by content hash; pass cache from a worker thread.
+    """
+    cache = cache or get_compressed_image_cache()
+    key = (hashlib.sha256(data).hexdigest(), mime_type, IMAGE_MAX_EDGE, IMAGE_TARGET_BYTES)
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+    result = compress_image_uncached(data, mime_type)
+    cache.put(key, result)
+    return result
+
+def compress_image_uncached(data, mime_type):
+    started = time.monotonic()
+    image_module = lazy_import("PIL.Image")
+    image = image_module.open(BytesIO(data))
+    has_metadata = has_image_metadata(image)
+    if getattr(image, "n_frames", 1) > 1:
+        # Keep animations intact apart from their metadata
+        return (strip_animation_metadata(image) if has_metadata else data), mime_type
+    
+    # Let the JPEG decoder skip straight to a nearby scale instead of decoding every pixel
+    image.draft("RGB", (IMAGE_MAX_EDGE, IMAGE_MAX_EDGE))
+    # Bake in the EXIF rotation before the metadata is dropped
+    image = lazy_import("PIL.ImageOps").exif_transpose(image)
+    image.thumbnail((IMAGE_MAX_EDGE, IMAGE_MAX_EDGE), image_module.LANCZOS)
+    has_alpha = image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info)
+    image = image.convert("RGBA" if has_alpha else "RGB")
+    
+    # Binary search for the highest quality that fits the target size
+    qualities = list(range(IMAGE_QUALITY_RANGE[0], IMAGE_QUALITY_RANGE[1] + 1, IMAGE_QUALITY_STEP))
+    low, high = 0, len(qualities) - 1
+    best = None
+    while low <= high:
+        middle = (low + high) // 2
+        encoded, encoded_type = encode_image(image, qualities[middle])
+        if len(encoded) <= IMAGE_TARGET_BYTES:
+            best = (encoded, encoded_type)
+            low = middle + 1
+        else:
+            high = middle - 1
+    if best is None:
+        best = encode_image(image, qualities[0])
+    
+    encoded, encoded_type = best
+    elapsed_ms = (time.monotonic() - started) * 1000
+    if len(encoded) >= len(data):
+        if not has_metadata:
+            logger.info("Kept original %s (%d bytes); re-encoding saved nothing in %.0f ms", mime_type, len(data), elapsed_ms)
+            return data, mime_type
+        # Slightly larger, but the original would send its EXIF/GPS data along
+        logger.info("Re-encoded %s %d -> %d bytes to strip metadata in %.0f ms", mime_type, len(data), len(encoded), elapsed_ms)
+        return encoded, encoded_type
+    logger.info(
+        "Compressed %s %d -> %d bytes (%d saved) as %s in %.0f ms",
+        mime_type, len(data), len(encoded), len(data) - len(encoded), encoded_type, elapsed_ms
+    )
+    return encoded, encoded_type
+
+def prepare_attachment_part(data, mime_type, display_name, registry=None, compress_images=True, image_cache=None):
+    if compress_images and mime_type.startswith('image/'):
         try:
-            pdf_document = fitz.open(stream=file.read(), filetype="pdf")
-            text = ""
-            for page_num in range(len(pdf_document)):
-                page = pdf_document[page_num]
-                text += page.get_text()
-            return text
-        except:
-            # Fall back to PyPDF2 if PyMuPDF fails
-            file.seek(0)  # Reset file pointer
-            pdf = PdfReader(file)
-            text = ""
-            for page in pdf.pages:
-                text += page.extract_text()
-            return text
+            data, mime_type = compress_image(data, mime_type, image_cache)
+        except Exception as e:
+            logger.warning("Sending %s uncompressed: %s", display_name, e)
+    return prepare_file_part(data, mime_type, display_name, registry)
+
+EXTRACTION_WORKERS = int(os.getenv("MAINFRAME_EXTRACTION_WORKERS", os.cpu_count() or 2))
+# Documents with fewer pages than this are extracted inline rather than in the pool
+PDF_MIN_PAGES_PER_TASK = 8
+
+EXTRACTION_POOL_LOCK = threading.Lock()
+
+def extraction_pool_context():
+    # Forking the multithreaded server can hand a child locks held by other threads mid-fork
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    return multiprocessing.get_context(method)
+
+@st.cache_resource
+def get_extraction_pool():
+    return ProcessPoolExecutor(max_workers=EXTRACTION_WORKERS, mp_context=extraction_pool_context())
+
+def iter_extraction_pool(fn, *iterables):
+    """Executor.map over the shared extraction pool, yielding each result in order as it is ready.
+
+    A worker process that dies leaves a ProcessPoolExecutor permanently broken, so a broken
+    pool is dropped from the cache and the items not yet yielded retried once on a fresh one.
+    """
+    pending = deque(zip(*iterables))
+    for _ in range(2):
+        if not pending:
+            return
+        pool = get_extraction_pool()
+        try:
+            for result in pool.map(fn, *zip(*pending)):
+                pending.popleft()
+                yield result
+            return
+        except BrokenProcessPool:
+            logger.warning("Extraction process pool broke; starting a new one")
+            with EXTRACTION_POOL_LOCK:
+                # Another session may already have replaced it
+                if get_extraction_pool() is pool:
+                    get_extraction_pool.clear()
+            pool.shutdown(wait=False, cancel_futures=True)
+    raise Exception("Extraction worker process crashed")
+
+def map_extraction_pool(fn, *iterables):
+    """Like iter_extraction_pool, but waits for every result and returns them as a list."""
+    return list(iter_extraction_pool(fn, *iterables))
+
+@contextmanager
+def shared_pdf_file(data):
+    """Writes PDF bytes to a temporary file for pool workers to open, removing it afterwards."""
+    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as pdf_file:
+        pdf_file.write(data)
+    try:
+        yield pdf_file.name
+    finally:
+        try:
+            os.remove(pdf_file.name)
+        except OSError:
+            pass
+
+def split_page_numbers(page_numbers, min_per_task=PDF_MIN_PAGES_PER_TASK):
+    """Splits pages into at most one contiguous range per extraction worker."""
+    tasks = max(1, min(EXTRACTION_WORKERS, len(page_numbers) // min_per_task))
+    size, extra = divmod(len(page_numbers), tasks)
+    ranges = []
+    start = 0
+    for index in range(tasks):
+        end = start + size + (1 if index < extra else 0)
+        ranges.append(page_numbers[start:end])
+        start = end
+    return ranges
+
+def parse_page_ranges(spec, page_count):
+    """Turns a spec like "1-3, 7, 10-" (1-based, inclusive) into sorted 0-based page numbers."""
+    if not spec or not spec.strip():
+        return list(range(page_count))
+    
+    pages = set()
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            start, _, end = part.partition('-')
+            start = int(start) if start.strip() else 1
+            end = int(end) if end.strip() else page_count
+        else:
+            start = end = int(part)
+        if start < 1 or end < start:
+            raise ValueError(f"Invalid page range: {part}")
+        pages.update(range(start - 1, min(end, page_count)))
+    return sorted(pages)
+
+def iter_pdf_pages(data, pages=None):
+    """Yields (page_number, text) in page order, extracting ranges of pages in parallel."""
+    fitz = optional_import("fitz")
+    if fitz is not None:
+        try:
+            with fitz.open(stream=data, filetype="pdf") as pdf_document:
+                page_count = len(pdf_document)
+        except Exception:
+            page_count = None
+        
+        if page_count is not None:
+            page_numbers = parse_page_ranges(pages, page_count)
+            ranges = split_page_numbers(page_numbers)
+            with ExitStack() as stack:
+                if len(ranges) <= 1:
+                    results = [extraction_workers.extract_pdf_page_texts(data, page_numbers)]
+                else:
+                    # One range per worker, all reading the same file, which is kept until the
+                    # generator finishes; each range's pages are yielded as soon as it is done
+                    path = stack.enter_context(shared_pdf_file(data))
+                    results = iter_extraction_pool(
+                        extraction_workers.extract_pdf_page_texts, [path] * len(ranges), ranges
+                    )
+                for result in results:
+                    if isinstance(result, str):
+                        raise Exception(result)
+                    yield from result
+            return
+    
+    # Fall back to PyPDF2 if PyMuPDF is unavailable or can't open the file
+    pdf = lazy_import("PyPDF2").PdfReader(BytesIO(data))
+    for page_num in parse_page_ranges(pages, len(pdf.pages)):
+        yield page_num, pdf.pages[page_num].extract_text() or ""
+
+# Pages with fewer non-whitespace characters than this are treated as scans and OCR'd
+SCANNED_PAGE_MIN_CHARS = 30
+
+def is_scanned_page(text):
+    return len(''.join(text.split())) < SCANNED_PAGE_MIN_CHARS
+
+def extract_pdf_document(data, pages=None):
+    """Extracts text page by page, routing pages without a usable text layer to OCR.
+
+    Returns a dict with the merged "text", the ordered "pages" as (page_number, text)
+    pairs, and a "provenance" map from 1-based page number to "text", "ocr" or "empty".
+    """
+    page_texts = dict(iter_pdf_pages(data, pages))
+    provenance = {
+        page_num + 1: "empty" if is_scanned_page(text) else "text"
+        for page_num, text in page_texts.items()
+    }
+    
+    scanned = [page_num for page_num, text in page_texts.items() if is_scanned_page(text)]
+    if scanned and optional_import("fitz") is not None:
+        # OCR is slow enough per page that even a few scanned pages are spread across workers
+        ranges = split_page_numbers(scanned, min_per_task=1)
+        try:
+            with shared_pdf_file(data) as path:
+                results = map_extraction_pool(extraction_workers.ocr_pdf_pages, [path] * len(ranges), ranges)
+        except Exception as e:
+            logger.warning("OCR of scanned PDF pages failed: %s", e)
+            results = []
+        for page_num, ocr_text in (item for result in results for item in result):
+            if ocr_text.startswith("Error "):
+                logger.warning("OCR of scanned PDF page %d failed: %s", page_num + 1, ocr_text)
+                continue
+            if len(ocr_text.strip()) > len(page_texts[page_num].strip()):
+                page_texts[page_num] = ocr_text
+                provenance[page_num + 1] = "ocr"
+    
+    ordered = sorted(page_texts.items())
+    return {
+        "text": "".join(text for _, text in ordered),
+        "pages": ordered,
+        "provenance": provenance,
+    }
+
+def extract_pdf_text(file, pages=None):
+    try:
+        document = extract_pdf_document(file.read(), pages)
+        logger.info("PDF page provenance: %s", document["provenance"])
+        return normalize_document([text for _, text in document["pages"]], "PDF")
     except Exception as e:
         return f"Error extracting PDF text: {str(e)}"
 
+WORD_NAMESPACE = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+# Drawing objects repeat their text box content here for old Word versions
+MARKUP_FALLBACK_TAG = "{http://schemas.openxmlformats.org/markup-compatibility/2006}Fallback"
+DOCX_TEXT_TAGS = {
+    WORD_NAMESPACE + "t": "",
+    WORD_NAMESPACE + "tab": "\t",
+    WORD_NAMESPACE + "br": "\n",
+    WORD_NAMESPACE + "cr": "\n",
+}
+
+def iter_docx_blocks(file):
+    """Yields the paragraphs and table rows of a .docx in document order.
+
+    Streams word/document.xml instead of building python-docx's object model. Table rows
+    come out as "cell | cell" lines; a cell's paragraphs (and nested tables) are joined
+    with spaces.
+    """
+    etree = lazy_import("lxml.etree")
+    paragraph_tag = WORD_NAMESPACE + "p"
+    row_tag = WORD_NAMESPACE + "tr"
+    cell_tag = WORD_NAMESPACE + "tc"
+    run_tag = WORD_NAMESPACE + "r"
+    tags = [paragraph_tag, row_tag, cell_tag, run_tag, MARKUP_FALLBACK_TAG, *DOCX_TEXT_TAGS]
+    
+    paragraphs = []
+    rows = []
+    cells = []
+    fallback_depth = 0
+    # Text only counts inside a run; w:tab also appears in w:pPr/w:tabs as a tab-stop definition
+    run_depth = 0
+    
+    def emit(text):
+        # Anything inside a table cell belongs to that cell instead of the output
+        if cells:
+            cells[-1].append(text)
+            return None
+        return text
+    
+    with zipfile.ZipFile(file) as archive, archive.open("word/document.xml") as document:
+        for event, element in etree.iterparse(document, events=("start", "end"), tag=tags):
+            tag = element.tag
+            if tag == MARKUP_FALLBACK_TAG:
+                fallback_depth += 1 if event == "start" else -1
+                continue
+            if fallback_depth:
+                continue
+            if tag == run_tag:
+                run_depth += 1 if event == "start" else -1
+                continue
+            
+            if event == "start":
+                if tag == paragraph_tag:
+                    paragraphs.append([])
+                elif tag == row_tag:
+                    rows.append([])
+                elif tag == cell_tag:
+                    cells.append([])
+                continue
+            
+            if tag in DOCX_TEXT_TAGS:
+                if paragraphs and run_depth:
+                    paragraphs[-1].append(DOCX_TEXT_TAGS[tag] or element.text or "")
+                continue
+            
+            if tag == paragraph_tag:
+                block = emit("".join(paragraphs.pop()))
+            elif tag == cell_tag:
+                rows[-1].append(" ".join(text for text in cells.pop() if text.strip()))
+                continue
+            else:
+                block = emit(" | ".join(rows.pop()))
+            
+            # Finished top-level blocks are dropped from the tree to keep memory flat
+            element.clear()
+            if not cells and not paragraphs:
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+            if block is not None:
+                yield block
+
 def extract_docx_text(file):
     try:
-        doc = Document(file)
-        return "\n".join([paragraph.text for paragraph in doc.paragraphs])
+        return normalize_document(["\n".join(iter_docx_blocks(file))], "DOCX")
     except Exception as e:
         return f"Error extracting DOCX text: {str(e)}"
 
+# Lines seen in the top/bottom few lines of at least this share of pages are running headers/footers
+REPEATED_LINE_ZONE = 2
+REPEATED_LINE_MIN_SHARE = 0.6
+REPEATED_LINE_MIN_PAGES = 3
+# A page number standing alone or set off from header text: "12", "- 12 -", "Page 12 of 40",
+# "Unit 4 | 12", "12    Chapter Title"
+PAGE_NUMBER_SEPARATOR = r'(?:[|·•:–—-]\s*|\s{2,}|\t)'
+TRAILING_PAGE_NUMBER_PATTERN = re.compile(
+    r'(?:^[\s\-–—]*|' + PAGE_NUMBER_SEPARATOR + r'|\bpage\s*)(\d{1,4})(?:\s*(?:of|/)\s*\d{1,4})?[\s\-–—]*$',
+    re.IGNORECASE
+)
+LEADING_PAGE_NUMBER_PATTERN = re.compile(r'^(?:page\s*)?(\d{1,4})\s*' + PAGE_NUMBER_SEPARATOR, re.IGNORECASE)
+HYPHENATED_BREAK_PATTERN = re.compile(r'(\w+)-[ \t]*\n[ \t]*([a-z]\w*)')
+WORD_PATTERN = re.compile(r'\w+')
+INLINE_SPACE_PATTERN = re.compile(r'(?<=\S)[ \t\f\v\u00a0]+')
+EXTRA_BLANK_LINES_PATTERN = re.compile(r'\n{3,}')
+
+def running_line_keys(line, page_index):
+    """Returns the keys a header/footer line is matched on across pages.
+
+    The exact text always counts. A line ending or starting with a page number also counts with
+    that number masked, paired with its offset from page_index, so "Page 3", "Page 4", ... on
+    consecutive pages match each other but numeric table rows at page edges don't.
+    """
+    text = line.strip().lower()
+    keys = {(' '.join(text.split()), None)}
+    match = TRAILING_PAGE_NUMBER_PATTERN.search(text) or LEADING_PAGE_NUMBER_PATTERN.match(text)
+    if match:
+        masked = text[:match.start(1)] + '#' + text[match.end(1):]
+        keys.add((' '.join(masked.split()), int(match.group(1)) - page_index))
+    return keys
+
+def strip_running_lines(pages):
+    """Drops header/footer lines and page numbers repeated across most pages; returns (pages, lines_removed)."""
+    if len(pages) < REPEATED_LINE_MIN_PAGES:
+        return pages, 0
+    page_lines = [text.splitlines() for text in pages]
+    
+    def edge_indexes(lines):
+        filled = [index for index, line in enumerate(lines) if line.strip()]
+        return set(filled[:REPEATED_LINE_ZONE] + filled[-REPEATED_LINE_ZONE:])
+    
+    counts = Counter()
+    for page_index, lines in enumerate(page_lines):
+        counts.update(set().union(*(running_line_keys(lines[index], page_index) for index in edge_indexes(lines))))
+    min_pages = max(REPEATED_LINE_MIN_PAGES, len(pages) * REPEATED_LINE_MIN_SHARE)
+    repeated = {key for key, count in counts.items() if count >= min_pages}
+    if not repeated:
+        return pages, 0
+    
+    cleaned = []
+    removed = 0
+    for page_index, lines in enumerate(page_lines):
+        edges = edge_indexes(lines)
+        kept = []
+        for index, line in enumerate(lines):
+            if index in edges and not repeated.isdisjoint(running_line_keys(line, page_index)):
+                removed += 1
+                continue
+            kept.append(line)
+        cleaned.append("\n".join(kept))
+    return cleaned, removed
+
+def join_hyphenated_breaks(text):
+    # Drop the hyphen only if the joined word appears elsewhere, so "well-\nknown" stays "well-known"
+    if not HYPHENATED_BREAK_PATTERN.search(text):
+        return text
+    words = set(WORD_PATTERN.findall(text.lower()))
+    
+    def join(match):
+        head, tail = match.groups()
+        if (head + tail).lower() in words:
+            return head + tail
+        return f"{head}-{tail}"
+    
+    return HYPHENATED_BREAK_PATTERN.sub(join, text)
+
+def normalize_text(text):
+    # Indentation is kept, since it carries structure in code and outlines
+    lines = [INLINE_SPACE_PATTERN.sub(' ', line).rstrip() for line in join_hyphenated_breaks(text).splitlines()]
+    return EXTRA_BLANK_LINES_PATTERN.sub('\n\n', "\n".join(lines)).strip("\n")
+
+def normalize_document(pages, label="document"):
+    """Cleans extracted text before it reaches a prompt and logs what that saved.
+
+    pages is a list of per-page texts (a single item for formats without pages).
+    """
+    original = "".join(pages)
+    pages, removed = strip_running_lines(pages)
+    text = normalize_text("\n".join(pages))
+    
+    bytes_before = len(original.encode('utf-8'))
+    bytes_after = len(text.encode('utf-8'))
+    logger.info(
+        "Normalized %s: %d -> %d bytes (~%d tokens saved, %d header/footer lines dropped)",
+        label, bytes_before, bytes_after, (len(original) - len(text)) // 4, removed
+    )
+    return text
+
+# Images taller than one tile are split into overlapping bands and OCR'd in parallel
+OCR_TILE_HEIGHT = 1600
+OCR_TILE_OVERLAP = 120
+
+def run_ocr_pipeline(image):
+    """Returns (text, timings) where timings maps each stage to seconds spent."""
+    timings = {}
+    
+    def timed(stage, fn, *args):
+        start = time.perf_counter()
+        result = fn(*args)
+        timings[stage] = time.perf_counter() - start
+        return result
+    
+    image_ops = lazy_import("PIL.ImageOps")
+    image = timed("normalize", extraction_workers.normalize_resolution, image_ops.exif_transpose(image))
+    image = timed("binarize", extraction_workers.binarize, image)
+    tiles = timed("tile", extraction_workers.split_into_tiles, image, OCR_TILE_HEIGHT, OCR_TILE_OVERLAP)
+    encoded = timed("encode", lambda: [extraction_workers.encode_tile(tile) for tile in tiles])
+    
+    def ocr_tiles():
+        if len(encoded) == 1:
+            return [extraction_workers.ocr_tile(encoded[0])]
+        return map_extraction_pool(extraction_workers.ocr_tile, encoded)
+    
+    tile_texts = timed("ocr", ocr_tiles)
+    for tile_text in tile_texts:
+        if tile_text.startswith("Error "):
+            raise Exception(tile_text)
+    text = timed("merge", extraction_workers.merge_tile_texts, tile_texts)
+    timings["tiles"] = len(tiles)
+    return text, timings
+
 def extract_image_text(file):
     try:
-        image = Image.open(file)
-        return pytesseract.image_to_string(image)
+        start = time.perf_counter()
+        image = lazy_import("PIL.Image").open(file)
+        image.load()
+        load_time = time.perf_counter() - start
+        
+        text, timings = run_ocr_pipeline(image)
+        timings["load"] = load_time
+        logger.info("OCR timings: %s", timings)
+        return text
     except Exception as e:
         return f"Error extracting image text: {str(e)}"
 
+XLSX_MIME_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+# Tables are read this many rows at a time, so memory depends on the chunk, not the file
+STRUCTURED_CHUNK_ROWS = 5000
+# Full rows are included only up to roughly this many tokens (4 characters each)
+STRUCTURED_TOKEN_BUDGET = 6000
+STRUCTURED_SAMPLE_ROWS = 5
+# Distinct values tracked per text column before counting stops growing
+STRUCTURED_MAX_TRACKED_VALUES = 1000
+
+def unique_column_names(columns):
+    """Renames repeated column names "name", "name.1", ... the way pandas.read_csv does."""
+    seen = Counter()
+    names = []
+    taken = {str(column) for column in columns}
+    for column in columns:
+        name = str(column)
+        if seen[name]:
+            candidate = f"{name}.{seen[name]}"
+            while candidate in taken:
+                seen[name] += 1
+                candidate = f"{name}.{seen[name]}"
+            taken.add(candidate)
+            seen[name] += 1
+            name = candidate
+        else:
+            seen[name] += 1
+        names.append(name)
+    return names
+
+class TableProfiler:
+    """Builds a compact description of a table fed in DataFrame chunks: schema, dtypes,
+    summary statistics, head/tail samples, and the full rows while they fit the budget."""
+
+    def __init__(self, title):
+        self.title = title
+        self.columns = None
+        self.dtypes = {}
+        self.row_count = 0
+        self.head = []
+        self.tail = deque(maxlen=STRUCTURED_SAMPLE_ROWS)
+        self.numeric = {}
+        self.values = {}
+        self.mixed = set()
+        self.nulls = {}
+        self.full_rows = []
+        self.full_rows_chars = 0
+        self.full_rows_complete = True
+
+    def add(self, chunk):
+        pd = lazy_import("pandas")
+        if self.columns is None:
+            self.columns = unique_column_names(chunk.columns)
+        
+        for index, column in enumerate(self.columns):
+            # Positional, since a header may repeat a name
+            series = chunk.iloc[:, index]
+            self.nulls[column] = self.nulls.get(column, 0) + int(series.isna().sum())
+            values = series.dropna()
+            if values.empty:
+                # An all-empty chunk says nothing about the column's type
+                continue
+            
+            dtype = str(series.dtype)
+            previous = self.dtypes.get(column)
+            if previous and previous != dtype and dtype not in previous.split('/'):
+                dtype = f"{previous}/{dtype}"
+            elif previous:
+                dtype = previous
+            self.dtypes[column] = dtype
+            
+            is_numeric = pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series)
+            if column in self.mixed:
+                continue
+            if (is_numeric and column in self.values) or (not is_numeric and column in self.numeric):
+                # Statistics from chunks of different types can't be combined
+                self.mixed.add(column)
+                self.values.pop(column, None)
+                self.numeric.pop(column, None)
+                continue
+            
+            if is_numeric:
+                stats = self.numeric.setdefault(column, {"count": 0, "sum": 0.0, "min": None, "max": None})
+                stats["count"] += int(values.count())
+                stats["sum"] += float(values.sum())
+                low, high = float(values.min()), float(values.max())
+                stats["min"] = low if stats["min"] is None else min(stats["min"], low)
+                stats["max"] = high if stats["max"] is None else max(stats["max"], high)
+            else:
+                counts = self.values.setdefault(column, Counter())
+                for value, count in values.astype(str).value_counts().items():
+                    if value in counts or len(counts) < STRUCTURED_MAX_TRACKED_VALUES:
+                        counts[value] += int(count)
+        
+        rows = chunk.to_csv(index=False, header=False).splitlines()
+        if len(self.head) < STRUCTURED_SAMPLE_ROWS:
+            self.head.extend(rows[:STRUCTURED_SAMPLE_ROWS - len(self.head)])
+        self.tail.extend(rows[-STRUCTURED_SAMPLE_ROWS:])
+        self.row_count += len(chunk)
+        
+        if self.full_rows_complete:
+            for row in rows:
+                if self.full_rows_chars + len(row) > STRUCTURED_TOKEN_BUDGET * 4:
+                    self.full_rows_complete = False
+                    break
+                self.full_rows.append(row)
+                self.full_rows_chars += len(row) + 1
+
+    def render(self):
+        if self.columns is None:
+            return f"{self.title}: empty"
+        
+        lines = [self.title, f"Rows: {self.row_count}, Columns: {len(self.columns)}", "Columns:"]
+        for column in self.columns:
+            details = [self.dtypes.get(column, "empty"), f"nulls {self.nulls[column]}"]
+            if column in self.mixed:
+                details.append("mixed types, no statistics")
+            elif column in self.numeric:
+                stats = self.numeric[column]
+                details.append(f"min {stats['min']:g}, max {stats['max']:g}, mean {stats['sum'] / stats['count']:g}")
+            elif column in self.values:
+                counts = self.values[column]
+                distinct = f"{len(counts)}+" if len(counts) >= STRUCTURED_MAX_TRACKED_VALUES else str(len(counts))
+                top = ", ".join(f"{value} ({count})" for value, count in counts.most_common(3))
+                details.append(f"distinct {distinct}, top: {top}")
+            lines.append(f"- {column}: " + "; ".join(details))
+        
+        header = ",".join(self.columns)
+        if self.full_rows_complete:
+            lines += ["All rows (CSV):", header] + self.full_rows
+        else:
+            first_rows = self.full_rows if len(self.full_rows) >= len(self.head) else self.head
+            lines += [f"First {len(first_rows)} of {self.row_count} rows (CSV, truncated to fit):", header] + first_rows
+            lines += [f"Last {len(self.tail)} rows (CSV):", header] + list(self.tail)
+        return "\n".join(lines)
+
+def profile_csv(file):
+    profiler = TableProfiler("CSV table")
+    for chunk in lazy_import("pandas").read_csv(file, chunksize=STRUCTURED_CHUNK_ROWS):
+        profiler.add(chunk)
+    return profiler.render()
+
+def profile_xlsx(file):
+    pd = lazy_import("pandas")
+    workbook = lazy_import("openpyxl").load_workbook(file, read_only=True, data_only=True)
+    try:
+        sections = []
+        for sheet in workbook.worksheets:
+            profiler = TableProfiler(f"Sheet: {sheet.title}")
+            rows = sheet.iter_rows(values_only=True)
+            header = None
+            for row in rows:
+                if any(cell is not None for cell in row):
+                    header = [str(cell) if cell is not None else f"column_{i + 1}" for i, cell in enumerate(row)]
+                    break
+            if header is None:
+                continue
+            
+            batch = []
+            for row in rows:
+                if not any(cell is not None for cell in row):
+                    continue
+                batch.append(list(row[:len(header)]) + [None] * (len(header) - len(row)))
+                if len(batch) >= STRUCTURED_CHUNK_ROWS:
+                    profiler.add(pd.DataFrame(batch, columns=header))
+                    batch = []
+            if batch or profiler.columns is None:
+                profiler.add(pd.DataFrame(batch, columns=header))
+            sections.append(profiler.render())
+        return "\n\n".join(sections) if sections else "Empty workbook"
+    finally:
+        workbook.close()
+
+# Caps for JSON/XML documents; whatever is cut is counted and reported after the output
+STRUCTURED_MAX_DEPTH = 8
+STRUCTURED_MAX_ITEMS = 50
+STRUCTURED_MAX_STRING = 500
+
+def describe_elisions(elided):
+    reasons = {
+        "depth": "nested values deeper than {} levels".format(STRUCTURED_MAX_DEPTH),
+        "items": "items past the first {} of an array or element".format(STRUCTURED_MAX_ITEMS),
+        "keys": "object keys past the first {}".format(STRUCTURED_MAX_ITEMS),
+        "strings": "strings cut to {} characters".format(STRUCTURED_MAX_STRING),
+        "size": "values dropped to stay within the size budget",
+    }
+    parts = [f"{count} {reasons[kind]}" for kind, count in elided.items() if count]
+    return f"\n[Elided: {'; '.join(parts)}]" if parts else ""
+
+class CappedJSONBuilder:
+    """Builds a size-capped copy of a JSON document from parse events, so large documents
+    never need to be held in memory in full."""
+
+    def __init__(self):
+        self.roots = []
+        self.stack = []
+        self.skip_depth = 0
+        self.skip_next_value = False
+        self.size = 0
+        self.max_size = STRUCTURED_TOKEN_BUDGET * 4
+        self.elided = {"depth": 0, "items": 0, "keys": 0, "strings": 0, "size": 0}
+
+    def _admit(self, value):
+        """Attaches a new value to its parent; returns False if the value must be skipped."""
+        if not self.stack:
+            self.roots.append(value)
+            return True
+        frame = self.stack[-1]
+        if isinstance(frame["value"], list):
+            if len(frame["value"]) >= STRUCTURED_MAX_ITEMS:
+                frame["elided"] += 1
+                self.elided["items"] += 1
+                return False
+            if self.size > self.max_size:
+                frame["elided"] += 1
+                self.elided["size"] += 1
+                return False
+            frame["value"].append(value)
+        else:
+            frame["value"][frame["key"]] = value
+        return True
+
+    def start(self, container):
+        if self.skip_depth:
+            self.skip_depth += 1
+            return
+        if self.skip_next_value:
+            self.skip_next_value = False
+            self.skip_depth = 1
+            return
+        if len(self.stack) >= STRUCTURED_MAX_DEPTH:
+            self.elided["depth"] += 1
+            self._admit("…")
+            self.skip_depth = 1
+            return
+        if not self._admit(container):
+            self.skip_depth = 1
+            return
+        self.size += 2
+        self.stack.append({"value": container, "key": None, "elided": 0})
+
+    def end(self):
+        if self.skip_depth:
+            self.skip_depth -= 1
+            return
+        frame = self.stack.pop()
+        if frame["elided"]:
+            if isinstance(frame["value"], list):
+                frame["value"].append(f"… {frame['elided']} more items")
+            else:
+                frame["value"]["…"] = f"{frame['elided']} more keys"
+
+    def key(self, key):
+        if self.skip_depth:
+            return
+        frame = self.stack[-1]
+        if len(frame["value"]) >= STRUCTURED_MAX_ITEMS or self.size > self.max_size:
+            frame["elided"] += 1
+            self.elided["keys" if self.size <= self.max_size else "size"] += 1
+            self.skip_next_value = True
+            return
+        frame["key"] = key
+        self.size += len(key) + 3
+
+    def scalar(self, value):
+        if self.skip_depth:
+            return
+        if self.skip_next_value:
+            self.skip_next_value = False
+            return
+        if isinstance(value, str) and len(value) > STRUCTURED_MAX_STRING:
+            value = value[:STRUCTURED_MAX_STRING] + "…"
+            self.elided["strings"] += 1
+        if self._admit(value):
+            self.size += len(value) + 3 if isinstance(value, str) else 6
+
+    def feed_object(self, value):
+        # Fallback for when ijson isn't installed: replay an already-parsed document as events
+        if isinstance(value, dict):
+            self.start({})
+            for key, item in value.items():
+                self.key(str(key))
+                self.feed_object(item)
+            self.end()
+        elif isinstance(value, list):
+            self.start([])
+            for item in value:
+                self.feed_object(item)
+            self.end()
+        else:
+            self.scalar(value)
+
+    def render(self):
+        document = self.roots[0] if len(self.roots) == 1 else self.roots
+        return json.dumps(document, separators=(',', ':'), ensure_ascii=False) + describe_elisions(self.elided)
+
+def summarize_json(file):
+    builder = CappedJSONBuilder()
+    ijson = optional_import("ijson")
+    if ijson is None:
+        builder.feed_object(json.load(file))
+        return builder.render()
+    
+    # multiple_values also accepts JSON Lines exports
+    for _, event, value in ijson.parse(file, multiple_values=True, use_float=True):
+        if event == 'start_map':
+            builder.start({})
+        elif event == 'start_array':
+            builder.start([])
+        elif event in ('end_map', 'end_array'):
+            builder.end()
+        elif event == 'map_key':
+            builder.key(value)
+        else:
+            builder.scalar(value)
+    return builder.render()
+
+def summarize_xml(file):
+    """Minified, capped rendering of an XML document, parsed incrementally with iterparse."""
+    element_tree = lazy_import("xml.etree.ElementTree")
+    escape = lazy_import("xml.sax.saxutils").escape
+    quoteattr = lazy_import("xml.sax.saxutils").quoteattr
+    max_size = STRUCTURED_TOKEN_BUDGET * 4
+    elided = {"depth": 0, "items": 0, "keys": 0, "strings": 0, "size": 0}
+    
+    def local_name(tag):
+        return tag.rsplit('}', 1)[-1]
+    
+    def collapse_text(text):
+        text = ' '.join((text or '').split())
+        if len(text) > STRUCTURED_MAX_STRING:
+            elided["strings"] += 1
+            text = text[:STRUCTURED_MAX_STRING] + "…"
+        return text
+    
+    def clean_text(text):
+        return escape(collapse_text(text))
+    
+    out = []
+    size = 0
+    # One frame per open, rendered element: [element, children_seen, text_written, previous_child]
+    stack = []
+    skip_depth = 0
+    
+    def write(text):
+        nonlocal size
+        out.append(text)
+        size += len(text)
+    
+    def flush_before_child(frame):
+        element, _, text_written, previous = frame
+        if not text_written:
+            write(clean_text(element.text))
+            frame[2] = True
+        if previous is not None:
+            write(clean_text(previous.tail))
+            element.remove(previous)
+            frame[3] = None
+    
+    for event, element in element_tree.iterparse(file, events=("start", "end")):
+        if event == "start":
+            if skip_depth:
+                skip_depth += 1
+                continue
+            if stack:
+                parent = stack[-1]
+                flush_before_child(parent)
+                parent[1] += 1
+                if len(stack) >= STRUCTURED_MAX_DEPTH:
+                    elided["depth"] += 1
+                    skip_depth = 1
+                    continue
+                if parent[1] > STRUCTURED_MAX_ITEMS:
+                    elided["items"] += 1
+                    skip_depth = 1
+                    continue
+                if size > max_size:
+                    elided["size"] += 1
+                    skip_depth = 1
+                    continue
+            attributes = ''.join(
+                f" {local_name(name)}={quoteattr(collapse_text(value))}"
+                for name, value in element.attrib.items()
+            )
+            write(f"<{local_name(element.tag)}{attributes}>")
+            stack.append([element, 0, False, None])
+        else:
+            if skip_depth:
+                skip_depth -= 1
+                if skip_depth == 0 and stack:
+                    # Skipped subtree is done; drop it but keep its tail text
+                    stack[-1][3] = element
+                continue
+            frame = stack.pop()
+            flush_before_child(frame)
+            write(f"</{local_name(element.tag)}>")
+            if stack:
+                stack[-1][3] = element
+            else:
+                element.clear()
+    
+    return ''.join(out) + describe_elisions(elided)
+
 def process_structured_data(file, mime_type):
     try:
         if mime_type == 'text/csv':
-            df = pd.read_csv(file)
-            return df.to_string()
+            return profile_csv(file)
+        elif mime_type == XLSX_MIME_TYPE:
+            return profile_xlsx(file)
         elif mime_type == 'application/json':
-            return json.dumps(json.load(file), indent=2)
+            return summarize_json(file)
         elif mime_type == 'application/xml':
-            tree = ET.parse(file)
-            return ET.tostring(tree.getroot(), encoding='unicode', method='xml')
+            return summarize_xml(file)
         return file.read().decode('utf-8')
     except Exception as e:
         return f"Error processing structured data: {str(e)}"
 
+NUMBERED_ITEM_PATTERN = re.compile(r'\d+\.')
+# A whitespace run with at least three newlines (always matched in full)
+BLANK_RUN_PATTERN = re.compile(r'\s*\n\s*\n\s*\n\s*')
+
+class StreamingFormatter:
+    """Single-pass, chunk-at-a-time version of the response formatting.
+
+    Feed text in arbitrary chunks; each call returns the output that can no longer
+    change. The stages mirror the original whole-text passes:
+      1. list items (numbered, * or -) are stripped and preceded by a blank line
+      2. whitespace runs containing three or more newlines collapse to one blank line
+      3. a blank line is inserted after a "* "/"- " item followed by non-list text
+      4. leading and trailing whitespace is stripped
+    """
+
+    def __init__(self):
+        self._line = ""
+        self._whitespace = ""
+        self._line_head = ""
+        self._line_len = 0
+        self._line_index = 0
+        self._pending_bullet = False
+        self._started = False
+        self._trailing = ""
+
+    def feed(self, chunk):
+        self._line += chunk
+        *lines, self._line = self._line.split('\n')
+        if not lines:
+            return ""
+        formatted = ''.join(self._format_line(line) + '\n' for line in lines)
+        return self._strip(self._separate_items(self._collapse_blank_lines(formatted)))
+
+    def finish(self):
+        text = self._collapse_blank_lines(self._format_line(self._line))
+        text += self._collapse_run(self._whitespace)
+        self._line = ""
+        self._whitespace = ""
+        text = self._strip(self._separate_items(text))
+        self._trailing = ""
+        return text
+
+    def pending(self):
+        # The line still being streamed, unformatted
+        return self._line
+
+    def _format_line(self, line):
+        stripped = line.strip()
+        if NUMBERED_ITEM_PATTERN.match(stripped) or stripped.startswith(('*', '-')):
+            return '\n' + stripped
+        return line
+
+    def _collapse_run(self, run):
+        if run.count('\n') < 3:
+            return run
+        return run[:run.index('\n')] + '\n\n' + run[run.rindex('\n') + 1:]
+
+    def _collapse_blank_lines(self, text):
+        # Trailing whitespace is held back: the next chunk may extend the run
+        text = self._whitespace + text
+        body = text.rstrip()
+        self._whitespace = text[len(body):]
+        return BLANK_RUN_PATTERN.sub(lambda match: self._collapse_run(match.group()), body)
+
+    def _separate_items(self, text):
+        out = []
+        pos = 0
+        while pos < len(text):
+            if self._pending_bullet:
+                if text[pos] not in '*-\n':
+                    out.append('\n')
+                self._pending_bullet = False
+            newline = text.find('\n', pos)
+            segment = text[pos:] if newline == -1 else text[pos:newline]
+            if len(self._line_head) < 3:
+                self._line_head += segment[:3 - len(self._line_head)]
+            self._line_len += len(segment)
+            if newline == -1:
+                out.append(segment)
+                break
+            out.append(segment + '\n')
+            # An item line needs a newline before it, so the first line never counts
+            self._pending_bullet = (
+                self._line_index > 0
+                and self._line_len >= 3
+                and self._line_head[0] in '*-'
+                and self._line_head[1] == ' '
+            )
+            self._line_head = ""
+            self._line_len = 0
+            self._line_index += 1
+            pos = newline + 1
+        return ''.join(out)
+
+    def _strip(self, text):
+        if not self._started:
+            text = text.lstrip()
+            if not text:
+                return ""
+            self._started = True
+        text = self._trailing + text
+        stripped = text.rstrip()
+        self._trailing = text[len(stripped):]
+        return stripped
+
 def process_response(text):
-    lines = text.split('\n')
-    processed_lines = []
-    
-    for line in lines:
-        if re.match(r'^\d+\.', line.strip()):
-            processed_lines.append('\n' + line.strip())
-        elif line.strip().startswith('*') or line.strip().startswith('-'):
-            processed_lines.append('\n' + line.strip())
-        else:
-            processed_lines.append(line)
-    
-    text = '\n'.join(processed_lines)
-    text = re.sub(r'\n\s*\n\s*\n', '\n\n', text)
-    text = re.sub(r'(\n[*-] .+?)(\n[^*\n-])', r'\1\n\2', text)
-    
-    return text.strip()
+    formatter = StreamingFormatter()
+    return formatter.feed(text) + formatter.finish()
 
 # Add this function to handle clipboard data
 def handle_clipboard_data():
@@ -762,6 +2126,219 @@ def detect_file_type(uploaded_file):
     mime_type, _ = mimetypes.guess_type(filename)
     return mime_type or 'application/octet-stream'
     
+# Maximum concurrent Gemini requests multiplexed over the process's shared client
+MODEL_POOL_SIZE = int(os.getenv("MAINFRAME_MODEL_POOL_SIZE", "32"))
+
+class ModelPool:
+    """One GenerativeModel (and so one keep-alive gRPC channel) shared by all sessions,
+    with a bounded number of request slots and utilization stats."""
+
+    def __init__(self, model, size):
+        self.model = model
+        self.size = size
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._in_use = 0
+        self._peak_in_use = 0
+        self._leases = 0
+        self._waited_leases = 0
+        self._total_wait = 0.0
+
+    @contextmanager
+    def lease(self):
+        start = time.perf_counter()
+        self._slots.acquire()
+        waited = time.perf_counter() - start
+        with self._lock:
+            self._in_use += 1
+            self._peak_in_use = max(self._peak_in_use, self._in_use)
+            self._leases += 1
+            self._total_wait += waited
+            if waited > 0.001:
+                self._waited_leases += 1
+        try:
+            yield self.model
+        finally:
+            with self._lock:
+                self._in_use -= 1
+            self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": self.size,
+                "in_use": self._in_use,
+                "peak_in_use": self._peak_in_use,
+                "utilization": self._in_use / self.size,
+                "leases": self._leases,
+                "waited_leases": self._waited_leases,
+                "avg_wait_s": self._total_wait / self._leases if self._leases else 0.0,
+            }
+
+@st.cache_resource
+def get_model_pool():
+    model = genai.GenerativeModel(
+        model_name=CHAT_MODEL_NAME,
+        generation_config=generation_config,
+        system_instruction=SYSTEM_INSTRUCTION,
+    )
+    return ModelPool(model, MODEL_POOL_SIZE)
+
+# Process-wide request budget, sized to the API quota
+REQUESTS_PER_MINUTE = int(os.getenv("MAINFRAME_REQUESTS_PER_MINUTE", "60"))
+REQUEST_BURST = int(os.getenv("MAINFRAME_REQUEST_BURST", "10"))
+RATE_LIMIT_MAX_RETRIES = 5
+RATE_LIMIT_BASE_BACKOFF = 1.0
+RATE_LIMIT_MAX_BACKOFF = 32.0
+# Give up instead of queueing forever if the backlog never drains
+REQUEST_QUEUE_TIMEOUT = 180
+
+class RequestScheduler:
+    """Token bucket in front of the model, serving waiting sessions round-robin.
+
+    Each session has its own FIFO of pending requests; sessions take turns, so one
+    student firing many requests can't starve everyone else during a burst.
+    """
+
+    def __init__(self, requests_per_minute, burst):
+        self.rate = requests_per_minute / 60.0
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._queues = OrderedDict()
+        self._cond = threading.Condition()
+        self.stats = {"served": 0, "queued": 0, "rate_limited": 0, "timeouts": 0}
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _position(self, session_id, ticket):
+        """1-based position in the round-robin service order."""
+        rotation = list(self._queues)
+        own_rotation_index = rotation.index(session_id)
+        own_index = self._queues[session_id].index(ticket)
+        ahead = 0
+        for rotation_index, other_id in enumerate(rotation):
+            queue_length = len(self._queues[other_id])
+            # Full rounds before ours, then sessions ahead of us in our round
+            ahead += min(queue_length, own_index)
+            if rotation_index < own_rotation_index and queue_length > own_index:
+                ahead += 1
+        return ahead + 1
+
+    def _remove(self, session_id, ticket):
+        queue = self._queues.get(session_id)
+        if queue is None or ticket not in queue:
+            return
+        queue.remove(ticket)
+        if not queue:
+            del self._queues[session_id]
+        self._cond.notify_all()
+
+    def acquire(self, session_id, on_wait=None):
+        ticket = object()
+        deadline = time.monotonic() + REQUEST_QUEUE_TIMEOUT
+        last_position = None
+        with self._cond:
+            self._queues.setdefault(session_id, deque()).append(ticket)
+        try:
+            while True:
+                with self._cond:
+                    now = time.monotonic()
+                    self._refill(now)
+                    head_session = next(iter(self._queues))
+                    is_next = head_session == session_id and self._queues[session_id][0] is ticket
+                    if is_next and self._tokens >= 1 and now >= self._paused_until:
+                        self._tokens -= 1
+                        self._queues[session_id].popleft()
+                        # Move this session to the back of the rotation
+                        queue = self._queues.pop(session_id)
+                        if queue:
+                            self._queues[session_id] = queue
+                        self.stats["served"] += 1
+                        self._cond.notify_all()
+                        return
+                    if now > deadline:
+                        self.stats["timeouts"] += 1
+                        raise TimeoutError("Timed out waiting in the request queue")
+                    position = self._position(session_id, ticket)
+                    token_wait = max(0.0, (1 - self._tokens) / self.rate)
+                    wait = max(token_wait, self._paused_until - now, 0.05)
+                    if last_position is None:
+                        self.stats["queued"] += 1
+                    self._cond.wait(min(wait, 0.5))
+                # UI callbacks run outside the lock
+                if on_wait and position != last_position:
+                    on_wait(position)
+                last_position = position
+        finally:
+            with self._cond:
+                self._remove(session_id, ticket)
+
+    def back_off(self, delay):
+        # A quota error means the bucket is overfull for the real limit: drain it and pause everyone
+        with self._cond:
+            self.stats["rate_limited"] += 1
+            self._tokens = 0.0
+            self._updated = time.monotonic()
+            self._paused_until = max(self._paused_until, time.monotonic() + delay)
+            self._cond.notify_all()
+
+    def queue_length(self):
+        with self._cond:
+            return sum(len(queue) for queue in self._queues.values())
+
+@st.cache_resource
+def get_request_scheduler():
+    return RequestScheduler(REQUESTS_PER_MINUTE, REQUEST_BURST)
+
+def is_rate_limit_error(error):
+    if isinstance(error, (google_exceptions.ResourceExhausted, google_exceptions.TooManyRequests)):
+        return True
+    message = str(error).lower()
+    return "429" in message or "rate_limit" in message or "quota" in message
+
+class StreamInterruptedError(Exception):
+    """A reply failed after it started streaming, so retrying would repeat a half-shown answer."""
+
+def run_model_request(request_fn, session_id, on_wait=None, pool=None, scheduler=None, trace=None):
+    """Runs request_fn(model) once the scheduler admits it, retrying quota errors with backoff.
+
+    on_wait(position) is called with the queue position while waiting, and with None
+    while backing off after a rate-limit error. Pass pool and scheduler when calling
+    from a worker thread. With a trace, each attempt's wait for the scheduler and a model
+    records a "queue_wait" span.
+    """
+    pool = pool or get_model_pool()
+    scheduler = scheduler or get_request_scheduler()
+    for attempt in range(RATE_LIMIT_MAX_RETRIES + 1):
+        queued_at = time.perf_counter()
+        scheduler.acquire(session_id, on_wait)
+        try:
+            with pool.lease() as model:
+                if trace is not None:
+                    trace.record("queue_wait", queued_at, time.perf_counter() - queued_at, attempt=attempt + 1)
+                return request_fn(model)
+        except Exception as e:
+            if isinstance(e, StreamInterruptedError) or not is_rate_limit_error(e) or attempt == RATE_LIMIT_MAX_RETRIES:
+                raise
+            backoff = min(RATE_LIMIT_MAX_BACKOFF, RATE_LIMIT_BASE_BACKOFF * 2 ** attempt)
+            scheduler.back_off(backoff)
+            if on_wait:
+                on_wait(None)
+            # Full jitter so retries from many sessions don't line up again
+            time.sleep(random.uniform(0, backoff))
+
+def queue_status_callback(message_placeholder):
+    def show_status(position):
+        if position is None:
+            message_placeholder.markdown("⏳ The AI service is busy, retrying shortly...")
+        elif position > 1:
+            message_placeholder.markdown(f"⏳ Lots of students are asking right now. You're #{position} in line...")
+    return show_status
+
 def initialize_session_state():
     # Initialize font preferences
     initialize_font_preferences()
@@ -769,15 +2346,15 @@ def initialize_session_state():
     apply_accessibility_settings()
     
     if 'chat_model' not in st.session_state:
-        st.session_state.chat_model = genai.GenerativeModel(
-            model_name="gemini-1.5-flash",
-            generation_config=generation_config,
-            system_instruction=SYSTEM_INSTRUCTION,
-        )
+        # Shared by every session; only the chat history below is per session
+        st.session_state.chat_model = get_model_pool().model
 
     if 'chat_session' not in st.session_state:
         st.session_state.chat_session = st.session_state.chat_model.start_chat(history=[])
 
+    if 'session_id' not in st.session_state:
+        st.session_state.session_id = uuid.uuid4().hex
+
     if 'messages' not in st.session_state:
         initial_message = """Hello! Mainframe AI speaking. How can I assist you today?"""
         st.session_state.messages = [
@@ -807,57 +2384,1018 @@ def initialize_session_state():
     if 'show_custom_cmd_form' not in st.session_state:
         st.session_state.show_custom_cmd_form = False
 
+# Chat history sent with each turn is kept under this many (estimated) tokens
+HISTORY_TOKEN_BUDGET = 24000
+# Most recent user/model exchanges that are always resent verbatim
+HISTORY_KEEP_TURNS = 6
+# Rough token cost of one image/document reference, used only for budgeting
+ATTACHMENT_TOKEN_ESTIMATE = 258
+HISTORY_SUMMARY_PREFIX = "Summary of our earlier conversation:"
+
+def estimate_content_tokens(content):
+    tokens = 0
+    for part in content.parts:
+        if part.text:
+            tokens += len(part.text) // 4 + 1
+        elif "inline_data" in part or "file_data" in part:
+            tokens += ATTACHMENT_TOKEN_ESTIMATE
+    return tokens
+
+def strip_answered_attachments(history):
+    # Once the model has replied to a turn, its attachments only add payload to later turns
+    stripped = []
+    for index, content in enumerate(history):
+        answered = index + 1 < len(history)
+        if content.role == "user" and answered:
+            parts = []
+            for part in content.parts:
+                if "inline_data" in part:
+                    parts.append(genai.protos.Part(text=f"[attachment: {part.inline_data.mime_type}]"))
+                elif "file_data" in part:
+                    parts.append(genai.protos.Part(text=f"[attachment: {part.file_data.mime_type}]"))
+                elif part.text and ATTACHMENT_TEXT_PATTERN.match(part.text):
+                    # Extracted attachment text is resent with every turn that still has the file attached
+                    name = ATTACHMENT_TEXT_PATTERN.match(part.text).group(1)
+                    parts.append(genai.protos.Part(text=f"[attachment text: {name}]"))
+                else:
+                    parts.append(part)
+            content = genai.protos.Content(role=content.role, parts=parts)
+        stripped.append(content)
+    return stripped
+
+def group_history_turns(history):
+    turns = []
+    for content in history:
+        if content.role == "user" or not turns:
+            turns.append([content])
+        else:
+            turns[-1].append(content)
+    return turns
+
+def summarize_history_turns(previous_summary, turns):
+    transcript = []
+    for turn in turns:
+        for content in turn:
+            speaker = "Student" if content.role == "user" else "Mainframe AI"
+            text = " ".join(part.text for part in content.parts if part.text)
+            transcript.append(f"{speaker}: {text}")
+    
+    prompt = (
+        "Update the running summary of a tutoring conversation. Keep every fact, definition, "
+        "decision and open question the student may refer back to. Be concise.\n\n"
+        f"Current summary:\n{previous_summary or '(none)'}\n\n"
+        "New conversation to fold in:\n" + "\n".join(transcript)
+    )
+    return run_model_request(
+        lambda model: model.generate_content(prompt).text.strip(),
+        st.session_state.session_id
+    )
+
+def compact_chat_history(chat_session):
+    """Keeps the resent history under HISTORY_TOKEN_BUDGET by summarizing older turns."""
+    history = strip_answered_attachments(list(chat_session.history))
+    
+    summary = st.session_state.get('history_summary', "")
+    if history and history[0].parts and history[0].parts[0].text.startswith(HISTORY_SUMMARY_PREFIX):
+        history = history[2:]
+    
+    turns = group_history_turns(history)
+    total_tokens = sum(estimate_content_tokens(content) for content in history)
+    
+    if total_tokens > HISTORY_TOKEN_BUDGET and len(turns) > HISTORY_KEEP_TURNS:
+        older, turns = turns[:-HISTORY_KEEP_TURNS], turns[-HISTORY_KEEP_TURNS:]
+        try:
+            # Only newly evicted turns are summarized; earlier ones are already in the cached summary
+            summary = summarize_history_turns(summary, older)
+            st.session_state.history_summary = summary
+        except Exception as e:
+            logger.warning("History summarization failed, keeping full history: %s", e)
+            turns = older + turns
+    
+    compacted = []
+    if summary:
+        compacted.append(genai.protos.Content(
+            role="user",
+            parts=[genai.protos.Part(text=f"{HISTORY_SUMMARY_PREFIX}\n{summary}")]
+        ))
+        compacted.append(genai.protos.Content(
+            role="model",
+            parts=[genai.protos.Part(text="Understood, I'll keep that context in mind.")]
+        ))
+    for turn in turns:
+        compacted.extend(turn)
+    chat_session.history = compacted
+
+# Answers to identical self-contained requests are reused while temperature is 0
+RESPONSE_CACHE_ENABLED = os.getenv("MAINFRAME_RESPONSE_CACHE", "1") != "0"
+RESPONSE_CACHE_MAX_ENTRIES = 512
+RESPONSE_CACHE_TTL = 6 * 60 * 60
+
+class ResponseCache:
+    """Thread-safe LRU of model answers whose entries also expire after a TTL."""
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "expired": 0, "evictions": 0}
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            expires_at, text = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                self.stats["expired"] += 1
+                self.stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return text
+
+    def put(self, key, text):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, text)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+@st.cache_resource
+def get_response_cache():
+    return ResponseCache(RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_TTL)
+
+def response_cache_allowed():
+    # Only deterministic, self-contained requests. The key doesn't cover earlier turns, so a
+    # turn with history (even a command turn) can depend on context the key knows nothing about.
+    if not RESPONSE_CACHE_ENABLED or generation_config.get("temperature") != 0:
+        return False
+    if not st.session_state.get('use_response_cache', True):
+        return False
+    return not st.session_state.chat_session.history
+
+def response_cache_key(command_prompt, user_text, file_hashes, pdf_pages=None, keep_original_images=False):
+    # Everything that changes what the model is sent: the PDF page range picks the extracted
+    # text, and keeping original images changes the image bytes themselves
+    key_source = json.dumps([
+        CHAT_MODEL_NAME,
+        SYSTEM_INSTRUCTION,
+        command_prompt,
+        ' '.join(user_text.split()),
+        sorted(file_hashes),
+        ''.join(pdf_pages.split()) if pdf_pages else None,
+        bool(keep_original_images),
+    ])
+    return hashlib.sha256(key_source.encode('utf-8')).hexdigest()
+
 def get_audio_hash(audio_data):
     return hashlib.md5(audio_data.getvalue()).hexdigest()
 
-def convert_audio_to_text(audio_file):
+# Speech recognizers, selected with MAINFRAME_SPEECH_BACKEND. "sphinx" and "vosk" run offline
+# (they need the pocketsphinx / vosk packages); add entries here to plug in another engine.
+SPEECH_BACKENDS = {
+    "google": lambda recognizer, audio: recognizer.recognize_google(audio),
+    "sphinx": lambda recognizer, audio: recognizer.recognize_sphinx(audio),
+    "vosk": lambda recognizer, audio: json.loads(recognizer.recognize_vosk(audio)).get("text", ""),
+}
+SPEECH_BACKEND = os.getenv("MAINFRAME_SPEECH_BACKEND", "google")
+SPEECH_FRAME_MS = 30
+# Pauses at least this long split the recording into separately transcribed segments
+SPEECH_MIN_SILENCE_MS = 400
+SPEECH_MAX_SEGMENT_SECONDS = 25
+SPEECH_WORKERS = 4
+
+def frame_energies(samples, frame_length):
+    energies = []
+    for start in range(0, len(samples), frame_length):
+        frame = samples[start:start + frame_length]
+        energies.append(sum(sample * sample for sample in frame) / max(1, len(frame)))
+    return energies
+
+def split_on_silence(samples, sample_rate):
+    """Returns (start, end) sample ranges of speech, cut in the middle of long pauses."""
+    frame_length = max(1, sample_rate * SPEECH_FRAME_MS // 1000)
+    energies = frame_energies(samples, frame_length)
+    if not energies:
+        return []
+    
+    # Adaptive threshold between the noise floor and typical speech loudness
+    ordered = sorted(energies)
+    noise_floor = ordered[len(ordered) // 10]
+    speech_level = ordered[(len(ordered) * 9) // 10]
+    threshold = noise_floor + 0.1 * (speech_level - noise_floor)
+    silent = [energy <= threshold for energy in energies]
+    
+    min_silence_frames = max(1, SPEECH_MIN_SILENCE_MS // SPEECH_FRAME_MS)
+    max_segment_frames = max(1, SPEECH_MAX_SEGMENT_SECONDS * 1000 // SPEECH_FRAME_MS)
+    
+    cuts = [0]
+    run_start = None
+    for index, is_silent in enumerate(silent + [False]):
+        if is_silent and run_start is None:
+            run_start = index
+        elif not is_silent and run_start is not None:
+            if index - run_start >= min_silence_frames:
+                cuts.append((run_start + index) // 2)
+            run_start = None
+    cuts.append(len(energies))
+    
+    segments = []
+    for start, end in zip(cuts, cuts[1:]):
+        # Break overly long stretches at their quietest frame so each request stays short
+        while end - start > max_segment_frames:
+            window_start = start + max_segment_frames // 2
+            window = energies[window_start:start + max_segment_frames]
+            split = window_start + window.index(min(window))
+            segments.append((start, split))
+            start = split
+        segments.append((start, end))
+    
+    return [
+        (start * frame_length, min(len(samples), end * frame_length))
+        for start, end in segments
+        if not all(silent[start:end])
+    ]
+
+def convert_audio_to_text(audio_bytes, backend=None):
+    sr = lazy_import("speech_recognition")
+    recognize = SPEECH_BACKENDS[backend or SPEECH_BACKEND]
     recognizer = sr.Recognizer()
+    
+    # Everything stays in memory: no temp file round trip
+    with sr.AudioFile(BytesIO(audio_bytes)) as source:
+        audio = recognizer.record(source)
+    raw = audio.get_raw_data(convert_width=2)
+    samples = array('h', raw)
+    if sys.byteorder == 'big':
+        samples.byteswap()
+    
+    segments = split_on_silence(samples, audio.sample_rate) or [(0, len(samples))]
+    
+    def transcribe(segment):
+        start, end = segment
+        chunk = sr.AudioData(raw[start * 2:end * 2], audio.sample_rate, 2)
+        try:
+            return recognize(recognizer, chunk)
+        except sr.UnknownValueError:
+            # A segment with no recognizable speech shouldn't sink the whole recording
+            return ""
+    
     try:
-        with sr.AudioFile(audio_file) as source:
-            audio_data = recognizer.record(source)
-            text = recognizer.recognize_google(audio_data)
-            return text
-    except sr.UnknownValueError:
-        raise Exception("Speech recognition could not understand the audio")
+        with ThreadPoolExecutor(max_workers=SPEECH_WORKERS) as executor:
+            texts = list(executor.map(transcribe, segments))
     except sr.RequestError as e:
         raise Exception(f"Could not request results from speech recognition service; {str(e)}")
+    
+    text = " ".join(part.strip() for part in texts if part and part.strip())
+    if not text:
+        raise Exception("Speech recognition could not understand the audio")
+    return text
+
+# Opt-in JSONL log of every turn's trace, for aggregation across processes. Traces carry
+# session IDs and attachment names, so nothing is written unless a path is configured.
+TRACE_LOG_PATH = os.getenv("MAINFRAME_TRACE_LOG")
+# Past this size the log is rotated to TRACE_LOG_PATH + ".1", replacing any older rotation
+TRACE_LOG_MAX_BYTES = int(os.getenv("MAINFRAME_TRACE_LOG_MAX_BYTES", 10 * 1024 * 1024))
+# Optional Prometheus textfile-collector target, rewritten after every turn
+METRICS_PATH = os.getenv("MAINFRAME_METRICS_PATH")
+# Recent traces kept in memory for the percentiles in the admin panel and metrics
+TRACE_HISTORY = 1000
+TRACE_QUANTILES = (0.5, 0.95, 0.99)
+
+class TurnTrace:
+    """Named timing spans for one chat turn; safe to record into from worker threads."""
+
+    def __init__(self, session_id, kind="chat"):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.session_id = session_id
+        self.kind = kind
+        self.status = "ok"
+        self.started_at = datetime.now(timezone.utc)
+        self.origin = time.perf_counter()
+        self.duration = None
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def record(self, name, start, duration, **attributes):
+        # start is a time.perf_counter() reading, so spans timed on other threads line up
+        span = {
+            "name": name,
+            "start_ms": round((start - self.origin) * 1000, 2),
+            "duration_ms": round(duration * 1000, 2),
+        }
+        if attributes:
+            span["attributes"] = attributes
+        with self._lock:
+            self.spans.append(span)
+
+    @contextmanager
+    def span(self, name, **attributes):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, start, time.perf_counter() - start, **attributes)
 
-def save_audio_file(audio_data):
-    audio_bytes = audio_data.getvalue()
-    with tempfile.NamedTemporaryFile(delete=False, suffix='.wav') as tmpfile:
-        tmpfile.write(audio_bytes)
-        return tmpfile.name
+    def finish(self):
+        self.duration = time.perf_counter() - self.origin
+        self.record("turn", self.origin, self.duration)
 
-def handle_chat_response(response, message_placeholder, command_message=""):
-    full_response = ""
+    def to_dict(self):
+        with self._lock:
+            spans = list(self.spans)
+        return {
+            "trace_id": self.trace_id,
+            "session_id": self.session_id,
+            "kind": self.kind,
+            "status": self.status,
+            "started_at": self.started_at.isoformat(),
+            "duration_ms": round((self.duration or 0.0) * 1000, 2),
+            "spans": spans,
+        }
+
+def percentile(sorted_values, quantile):
+    # Nearest-rank, so every reported value is one that was actually observed
+    index = max(0, math.ceil(quantile * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+class TraceCollector:
+    """Keeps recent turn traces for percentiles and, if given a log path, appends every finished
+    trace to a size-capped JSONL log."""
+
+    def __init__(self, log_path, history, max_log_bytes):
+        self.log_path = log_path
+        self.max_log_bytes = max_log_bytes
+        self.traces = deque(maxlen=history)
+        self._lock = threading.Lock()
+
+    def _write(self, record):
+        os.makedirs(os.path.dirname(os.path.abspath(self.log_path)), exist_ok=True)
+        try:
+            if os.path.getsize(self.log_path) >= self.max_log_bytes:
+                os.replace(self.log_path, self.log_path + ".1")
+        except FileNotFoundError:
+            pass
+        with open(self.log_path, "a", encoding="utf-8") as log_file:
+            log_file.write(json.dumps(record) + "\n")
+
+    def finish(self, trace):
+        trace.finish()
+        record = trace.to_dict()
+        with self._lock:
+            self.traces.append(record)
+            if self.log_path:
+                try:
+                    self._write(record)
+                except OSError as e:
+                    logger.warning("Could not write trace log: %s", e)
+        logger.info(
+            "Trace %s (session %s, %s): %s in %.0f ms",
+            trace.trace_id, trace.session_id, trace.kind, trace.status, record["duration_ms"]
+        )
+        return record
+
+    def recent(self, session_id=None, limit=20):
+        with self._lock:
+            traces = list(self.traces)
+        if session_id is not None:
+            traces = [trace for trace in traces if trace["session_id"] == session_id]
+        return traces[-limit:]
+
+    def percentiles(self):
+        """Returns {span name: {"count", "sum_ms", "p50", "p95", "p99"}} over the recent traces."""
+        durations = {}
+        with self._lock:
+            for trace in self.traces:
+                for span in trace["spans"]:
+                    durations.setdefault(span["name"], []).append(span["duration_ms"])
+        
+        summary = {}
+        for name, values in durations.items():
+            values.sort()
+            summary[name] = {"count": len(values), "sum_ms": sum(values)}
+            for quantile in TRACE_QUANTILES:
+                summary[name][f"p{round(quantile * 100)}"] = percentile(values, quantile)
+        return summary
+
+    def export_jsonl(self):
+        with self._lock:
+            return "".join(json.dumps(trace) + "\n" for trace in self.traces)
+
+@st.cache_resource
+def get_trace_collector():
+    # Shared by every session in this server process
+    return TraceCollector(TRACE_LOG_PATH, TRACE_HISTORY, TRACE_LOG_MAX_BYTES)
+
+def prometheus_metrics(collector, stats_groups):
+    """Renders span percentiles and component stats in the Prometheus text exposition format.
+
+    stats_groups maps a metric prefix (e.g. "model_pool") to a stats dict; non-numeric values are skipped.
+    """
+    lines = [
+        "# HELP mainframe_span_duration_seconds Duration of turn spans over the most recent traces.",
+        "# TYPE mainframe_span_duration_seconds summary",
+    ]
+    for name, summary in sorted(collector.percentiles().items()):
+        for quantile in TRACE_QUANTILES:
+            value = summary[f"p{round(quantile * 100)}"] / 1000
+            lines.append(f'mainframe_span_duration_seconds{{span="{name}",quantile="{quantile}"}} {value:.6f}')
+        lines.append(f'mainframe_span_duration_seconds_sum{{span="{name}"}} {summary["sum_ms"] / 1000:.6f}')
+        lines.append(f'mainframe_span_duration_seconds_count{{span="{name}"}} {summary["count"]}')
+    
+    for group, stats in sorted(stats_groups.items()):
+        for key, value in sorted(stats.items()):
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            metric = f"mainframe_{group}_{key}"
+            lines.append(f"# TYPE {metric} gauge")
+            lines.append(f"{metric} {value}")
+    return "\n".join(lines) + "\n"
+
+def current_component_stats():
+    return {
+        "extraction_cache": dict(get_extraction_cache().stats),
+        "response_cache": dict(get_response_cache().stats),
+        "model_pool": get_model_pool().stats(),
+        "request_scheduler": dict(get_request_scheduler().stats),
+    }
+
+def finish_turn_trace(trace):
+    collector = get_trace_collector()
+    record = collector.finish(trace)
+    if METRICS_PATH:
+        try:
+            # Written to a temp file and renamed so a scrape never sees a half-written file
+            temp_path = METRICS_PATH + ".tmp"
+            with open(temp_path, "w", encoding="utf-8") as metrics_file:
+                metrics_file.write(prometheus_metrics(collector, current_component_stats()))
+            os.replace(temp_path, METRICS_PATH)
+        except OSError as e:
+            logger.warning("Could not write metrics file: %s", e)
+    return record
+
+# Per-attachment time limits for a turn's preprocessing, counted from when each task starts
+# running. An attachment may wait out FILE_PROCESSING_TIMEOUT on the server before being
+# extracted, so giving up earlier would only abandon a worker that is still busy.
+ATTACHMENT_TIMEOUT = FILE_PROCESSING_TIMEOUT + 30
+AUDIO_TRANSCRIPTION_TIMEOUT = 120
+# How long a task may wait for a free worker before it is left out
+PREPROCESSING_QUEUE_TIMEOUT = 60
+PREPROCESSING_WORKERS = int(os.getenv("MAINFRAME_PREPROCESSING_WORKERS", 16))
+
+@st.cache_resource
+def get_preprocessing_pool():
+    # Shared so a timed-out task never makes the script thread wait for it to finish
+    return ThreadPoolExecutor(max_workers=PREPROCESSING_WORKERS, thread_name_prefix="preprocess")
+
+class PreprocessingTask:
+    """A job on the preprocessing pool whose time limit counts from when a worker picks it up."""
+
+    def __init__(self, pool, fn, *args):
+        self._started = threading.Event()
+        self._started_at = None
+        self.future = pool.submit(self._run, fn, *args)
+
+    def _run(self, fn, *args):
+        self._started_at = time.monotonic()
+        self._started.set()
+        return fn(*args)
+
+    def result(self, timeout):
+        """Raises FuturesTimeoutError after PREPROCESSING_QUEUE_TIMEOUT queued or timeout running."""
+        # A task still queued is cancelled so it never takes a worker
+        if not self._started.wait(PREPROCESSING_QUEUE_TIMEOUT) and self.future.cancel():
+            raise FuturesTimeoutError()
+        self._started.wait()
+        return self.future.result(timeout=max(0.0, self._started_at + timeout - time.monotonic()))
+
+def traced_call(trace, span_name, label, fn, *args):
+    # Timed on the worker so the span covers the work, not the wait for earlier results
+    start = time.perf_counter()
+    try:
+        return fn(*args)
+    finally:
+        if trace is not None:
+            trace.record(span_name, start, time.perf_counter() - start, attachment=label)
+
+def start_transcription(audio, trace=None):
+    """Starts transcribing on the preprocessing pool so it overlaps with attachment preprocessing.
+
+    Returns the task; its result(AUDIO_TRANSCRIPTION_TIMEOUT) is the transcript.
+    """
+    return PreprocessingTask(
+        get_preprocessing_pool(), traced_call, trace, "transcription", "voice input",
+        convert_audio_to_text, audio.getvalue()
+    )
+
+def part_payload_bytes(part):
+    """Bytes a prepared part adds to the request; a Files API handle carries only its URI."""
+    if isinstance(part, dict):
+        return len(part.get('data', b''))
+    if isinstance(part, str):
+        return len(part.encode('utf-8'))
+    return 0
+
+def preprocess_attachments(files, camera_image=None, trace=None, active_command=None, pdf_pages=None):
+    """Extracts, plans and prepares every attachment of a turn concurrently.
+
+    Returns (parts, errors). parts hold the media parts (uploaded files, then the camera image)
+    followed by extracted-text parts, in that order no matter which finishes first; attachments
+    that fail or exceed their timeout are left out and described in errors.
+    """
+    registry = get_file_registry()
+    extraction_cache = get_extraction_cache()
+    image_cache = get_compressed_image_cache()
+    pool = get_preprocessing_pool()
+    compress_images = not st.session_state.get('keep_original_images', False)
+    
+    attachments = [(file.name, file.getvalue(), detect_file_type(file), file.name) for file in files]
+    if camera_image:
+        attachments.append(("camera image", camera_image.getvalue(), 'image/jpeg', 'camera_image.jpg'))
+    tasks = []
+    for label, data, mime_type, display_name in attachments:
+        task = PreprocessingTask(
+            pool, traced_call, trace, "preprocess", label,
+            prepare_planned_attachment, data, mime_type, display_name, active_command, pdf_pages,
+            registry, extraction_cache, image_cache, compress_images, trace
+        )
+        tasks.append((label, task))
+    
+    media_parts = []
+    text_parts = []
+    errors = []
+    plan = []
+    payload_bytes = 0
+    for label, task in tasks:
+        try:
+            mode, reason, media_part, text_part = task.result(ATTACHMENT_TIMEOUT)
+        except FuturesTimeoutError:
+            errors.append(f"{label} took too long to process and was left out")
+            continue
+        except Exception as e:
+            errors.append(f"Error processing {label}: {str(e)}")
+            continue
+        plan.append((label, mode, reason))
+        if media_part is not None:
+            media_parts.append(media_part)
+            payload_bytes += part_payload_bytes(media_part)
+        if text_part is not None:
+            text_parts.append(text_part)
+            payload_bytes += part_payload_bytes(text_part)
+    
+    if plan:
+        stats = st.session_state.setdefault('payload_stats', {'turns': 0, 'bytes': 0})
+        stats['turns'] += 1
+        stats['bytes'] += payload_bytes
+        logger.info(
+            "Payload plan: %s; %d bytes this turn, %.0f average over %d turns",
+            plan, payload_bytes, stats['bytes'] / stats['turns'], stats['turns']
+        )
+    return media_parts + text_parts, errors
+
+def handle_chat_response(response, message_placeholder, command_message="", trace=None, request_started=None):
+    prefix = ""
+    request_started = request_started or time.perf_counter()
+    render_seconds = 0.0
+    renders = 0
+    first_chunk_at = None
     
     # First display command message if it exists
     if command_message:
-        full_response = f"{command_message}\n\n"
-        message_placeholder.markdown(full_response)
+        prefix = f"{command_message}\n\n"
+        message_placeholder.markdown(prefix)
     
-    # Process and format the AI response
-    formatted_response = process_response(response.text)
+    # Format and render chunks as they arrive, throttled so long answers don't repaint on every token
+    formatter = StreamingFormatter()
+    formatted = []
+    last_render = 0.0
+    pending_chars = 0
+    for chunk in response:
+        if first_chunk_at is None:
+            first_chunk_at = time.perf_counter()
+        try:
+            chunk_text = chunk.text
+        except ValueError:
+            # Chunks without text parts (e.g. safety metadata only)
+            continue
+        formatted.append(formatter.feed(chunk_text))
+        pending_chars += len(chunk_text)
+        now = time.monotonic()
+        if now - last_render >= STREAM_RENDER_INTERVAL or pending_chars >= STREAM_RENDER_MIN_CHARS:
+            partial = "".join(formatted) + formatter.pending()
+            message_placeholder.markdown(prefix + partial + "▌", unsafe_allow_html=True)
+            last_render = now
+            pending_chars = 0
+            render_seconds += time.monotonic() - now
+            renders += 1
+    generation_done = time.perf_counter()
+    
+    # Display final response without cursor
+    formatted.append(formatter.finish())
+    full_response = prefix + "".join(formatted)
+    message_placeholder.markdown(full_response, unsafe_allow_html=True)
+    render_seconds += time.perf_counter() - generation_done
+    
+    if trace is not None:
+        trace.record("time_to_first_token", request_started, (first_chunk_at or generation_done) - request_started)
+        trace.record("generation", request_started, generation_done - request_started)
+        # Repaints are interleaved with the stream, so this span is their summed time
+        trace.record("render", request_started, render_seconds, repaints=renders + 1)
+    return full_response
+
+def stream_chat_reply(input_parts, message_placeholder, command_message="", trace=None):
+    """Sends input_parts on the session's chat through the request queue and streams the reply."""
+    chat_session = st.session_state.chat_session
+    
+    def send(model):
+        request_started = time.perf_counter()
+        history = list(chat_session.history)
+        try:
+            # send_message returns once the first chunk has arrived, so errors here are safe to retry
+            response = chat_session.send_message(input_parts, stream=True)
+        except Exception:
+            chat_session.history = history
+            raise
+        try:
+            full_response = handle_chat_response(
+                response,
+                message_placeholder,
+                command_message,
+                trace,
+                request_started
+            )
+            # Reading history commits the exchange; it raises if the reply stopped early (e.g. SAFETY)
+            chat_session.history
+        except Exception as e:
+            # A broken exchange left on the session makes every later send_message fail
+            chat_session.history = history
+            if isinstance(e, genai.types.BrokenResponseError):
+                raise Exception("The response was stopped before it finished. Please rephrase your question.") from e
+            raise StreamInterruptedError(str(e)) from e
+        return full_response
+    
+    return run_model_request(
+        send,
+        st.session_state.session_id,
+        on_wait=queue_status_callback(message_placeholder),
+        trace=trace
+    )
+    
+# Markdown headings, "Chapter 3"-style labels, or short all-caps lines
+HEADING_PATTERN = re.compile(r'^(?:#{1,6}\s|(?i:chapter|part|section|act|scene)\b|[A-Z0-9][A-Z0-9 ,.:\'-]{3,}$)')
+HEADING_MAX_CHARS = 80
+
+def split_structural_chunks(text, max_chars):
+    """Packs paragraphs into chunks of at most max_chars, preferring to break at headings."""
+    blocks = [block.strip() for block in re.split(r'\n\s*\n', text) if block.strip()]
+    
+    # Paragraphs longer than a chunk are split at sentence ends, then hard-wrapped
+    pieces = []
+    for block in blocks:
+        if len(block) <= max_chars:
+            pieces.append(block)
+            continue
+        current = ""
+        for sentence in re.split(r'(?<=[.!?])\s+', block):
+            if len(sentence) > max_chars and current:
+                # Flush what came before the long sentence so its slices stay in order
+                pieces.append(current)
+                current = ""
+            while len(sentence) > max_chars:
+                pieces.append(sentence[:max_chars])
+                sentence = sentence[max_chars:]
+            if current and len(current) + len(sentence) + 1 > max_chars:
+                pieces.append(current)
+                current = ""
+            current = f"{current} {sentence}" if current else sentence
+        if current:
+            pieces.append(current)
     
-    # Split into chunks for streaming effect
     chunks = []
-    for line in formatted_response.split('\n'):
-        chunks.extend(line.split(' '))
-        chunks.append('\n')
-    
-    # Stream the response chunks with typing effect
-    for chunk in chunks:
-        if chunk != '\n':
-            full_response += chunk + ' '
+    current = []
+    current_len = 0
+    for piece in pieces:
+        first_line = piece.split('\n', 1)[0]
+        starts_section = len(first_line) <= HEADING_MAX_CHARS and bool(HEADING_PATTERN.match(first_line))
+        too_long = current_len + len(piece) + 2 > max_chars
+        if current and (too_long or (starts_section and current_len >= max_chars // 2)):
+            # Never leave a heading stranded at the end of a chunk
+            carried = []
+            last_line = current[-1].split('\n', 1)[0]
+            if len(current) > 1 and len(current[-1]) <= HEADING_MAX_CHARS and HEADING_PATTERN.match(last_line):
+                carried = [current.pop()]
+            chunks.append("\n\n".join(current))
+            current = carried
+            current_len = sum(len(block) + 2 for block in carried)
+        current.append(piece)
+        current_len += len(piece) + 2
+    if current:
+        chunks.append("\n\n".join(current))
+    return chunks
+
+def collect_long_input(prompt, files, pdf_pages=None):
+    """Returns the prompt plus any extracted document text if it is long enough for map-reduce."""
+    texts = [prompt]
+    if files:
+        for part in prepare_chat_input(prompt, files, pdf_pages)[:-1]:
+            if not part['content'].startswith("Error "):
+                texts.append(part['content'])
+    combined = "\n\n".join(texts)
+    return combined if len(combined) >= MAP_REDUCE_THRESHOLD_CHARS else None
+
+def run_map_reduce(command, text, prompt, message_placeholder, command_message=""):
+    spec = MAP_REDUCE_COMMANDS[command]
+    # Captured here because the map calls run on worker threads without a Streamlit context
+    pool = get_model_pool()
+    scheduler = get_request_scheduler()
+    session_id = st.session_state.session_id
+    chunks = split_structural_chunks(text, MAP_REDUCE_CHUNK_CHARS)
+    instructions = prompt[:MAP_REDUCE_INSTRUCTION_CHARS]
+    
+    def map_chunk(index, chunk):
+        map_prompt = (
+            f"{spec['map_prompt']}\n"
+            f"Student's instructions: {instructions}\n"
+            f"This is part {index + 1} of {len(chunks)}.\n\n{chunk}"
+        )
+        return run_model_request(
+            lambda model: model.generate_content(map_prompt).text,
+            session_id,
+            pool=pool,
+            scheduler=scheduler
+        )
+    
+    prefix = f"{command_message}\n\n" if command_message else ""
+    partials = [None] * len(chunks)
+    with ThreadPoolExecutor(max_workers=MAP_REDUCE_CONCURRENCY) as executor:
+        futures = {executor.submit(map_chunk, i, chunk): i for i, chunk in enumerate(chunks)}
+        for future in as_completed(futures):
+            partials[futures[future]] = future.result()
+            done = sum(1 for partial in partials if partial is not None)
+            # Show finished parts (in document order) while the rest are still running
+            progress = "\n\n".join(
+                f"**Part {i + 1} of {len(chunks)}**\n\n{partial}"
+                for i, partial in enumerate(partials) if partial is not None
+            )
+            message_placeholder.markdown(
+                f"{prefix}*Processed {done} of {len(chunks)} parts...*\n\n{progress}▌",
+                unsafe_allow_html=True
+            )
+    
+    if spec["reduce_prompt"] is None:
+        full_response = prefix + process_response("\n\n".join(partials))
+        message_placeholder.markdown(full_response, unsafe_allow_html=True)
+    else:
+        reduce_prompt = (
+            f"{spec['reduce_prompt']}\n"
+            f"Student's instructions: {instructions}\n\n"
+            + "\n\n".join(f"Part {i + 1}:\n{partial}" for i, partial in enumerate(partials))
+        )
+        full_response = run_model_request(
+            lambda model: handle_chat_response(
+                model.generate_content(reduce_prompt, stream=True),
+                message_placeholder,
+                command_message
+            ),
+            session_id,
+            on_wait=queue_status_callback(message_placeholder)
+        )
+    
+    # Record a compact version of the exchange so follow-up questions have context
+    append_history_exchange(
+        f"{command} (long input processed in {len(chunks)} parts): {instructions}",
+        full_response
+    )
+    return full_response
+
+def append_history_exchange(user_text, model_text):
+    # For answers produced outside chat_session.send_message
+    chat_session = st.session_state.chat_session
+    chat_session.history = list(chat_session.history) + [
+        genai.protos.Content(role="user", parts=[genai.protos.Part(text=user_text)]),
+        genai.protos.Content(role="model", parts=[genai.protos.Part(text=model_text)]),
+    ]
+
+GLOSSARY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "hug_fc.txt")
+# A fuzzy glossary match needs this trigram Dice similarity, the same words starting with the same
+# letters, and at most one edit per this many characters, so typos match but different terms that
+# share words ("cultural hearth" and "agricultural hearth", "revolution" and "devolution") don't
+GLOSSARY_FUZZY_THRESHOLD = 0.75
+GLOSSARY_CHARS_PER_EDIT = 8
+
+def fold_term(term):
+    term = unicodedata.normalize('NFKD', term)
+    term = ''.join(ch for ch in term if not unicodedata.combining(ch))
+    term = re.sub(r'[^\w\s]', ' ', term.casefold())
+    return ' '.join(term.split())
+
+def singular_term(folded):
+    # Folds simple English plurals word by word: "push factors" -> "push factor", "cities" -> "city"
+    words = []
+    for word in folded.split():
+        if len(word) > 4 and word.endswith('ies'):
+            word = word[:-3] + 'y'
+        elif len(word) > 3 and word.endswith('s') and not word.endswith(('ss', 'us', 'is')):
+            word = word[:-1]
+        words.append(word)
+    return ' '.join(words)
+
+def edit_distance(a, b):
+    previous = list(range(len(b) + 1))
+    for i, ch_a in enumerate(a, 1):
+        current = [i]
+        for j, ch_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ch_a != ch_b)))
+        previous = current
+    return previous[-1]
+
+def term_ngrams(folded, n=3):
+    padded = f" {folded} "
+    return {padded[i:i + n] for i in range(max(1, len(padded) - n + 1))}
+
+class GlossaryIndex:
+    """In-memory term lookup: exact, then case/accent-folded, then singular, then fuzzy by character trigrams."""
+
+    def __init__(self, entries):
+        self.exact = {}
+        self.folded = {}
+        self.singular = {}
+        self.ngram_postings = {}
+        self.ngram_counts = {}
+        for term, definition in entries:
+            self.exact[term] = (term, definition)
+            folded = fold_term(term)
+            if folded in self.folded:
+                continue
+            self.folded[folded] = (term, definition)
+            self.singular.setdefault(singular_term(folded), (term, definition))
+            grams = term_ngrams(folded)
+            self.ngram_counts[folded] = len(grams)
+            for gram in grams:
+                self.ngram_postings.setdefault(gram, []).append(folded)
+
+    @classmethod
+    def from_file(cls, path):
+        entries = []
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                term, sep, definition = line.partition(' | ')
+                if sep and term.strip() and definition.strip():
+                    entries.append((term.strip(), definition.strip()))
+        return cls(entries)
+
+    def lookup(self, term):
+        """Returns (canonical_term, definition, match_type) or None."""
+        term = term.strip()
+        if term in self.exact:
+            return (*self.exact[term], "exact")
+        
+        folded = fold_term(term)
+        if folded in self.folded:
+            return (*self.folded[folded], "folded")
+        singular = singular_term(folded)
+        if singular in self.singular:
+            return (*self.singular[singular], "singular")
+        
+        grams = term_ngrams(folded)
+        overlaps = Counter()
+        for gram in grams:
+            overlaps.update(self.ngram_postings.get(gram, ()))
+        best, best_distance = None, None
+        for candidate, shared in overlaps.items():
+            score = 2 * shared / (len(grams) + self.ngram_counts[candidate])
+            if score < GLOSSARY_FUZZY_THRESHOLD:
+                continue
+            if [word[0] for word in folded.split()] != [word[0] for word in candidate.split()]:
+                continue
+            distance = edit_distance(folded, candidate)
+            if distance > len(candidate) // GLOSSARY_CHARS_PER_EDIT:
+                continue
+            if best is None or distance < best_distance:
+                best, best_distance = candidate, distance
+        if best is not None:
+            return (*self.folded[best], "fuzzy")
+        return None
+
+@st.cache_resource
+def get_glossary_index():
+    return GlossaryIndex.from_file(GLOSSARY_PATH)
+
+def parse_term_list(text):
+    lines = [line for line in text.splitlines() if line.strip()]
+    if len(lines) == 1 and ',' in lines[0]:
+        lines = lines[0].split(',')
+    
+    terms = []
+    for line in lines:
+        # Drop list markers like "1.", "-", "*" and any trailing definition the student pasted
+        term = re.sub(r'^\s*(?:\d+[.)]|[-*•])\s*', '', line)
+        term = re.split(r'\s+[-–:|]\s+', term, maxsplit=1)[0].strip()
+        if term:
+            terms.append(term)
+    return terms
+
+def format_flashcard(term, definition, in_other_words=None, examples=None):
+    card = f"**{term}**: {definition}"
+    if in_other_words:
+        card += f"\n- **In Other Words:** {in_other_words}"
+    if examples:
+        card += f"\n- **Examples:** {', '.join(examples)}"
+    return card
+
+def parse_flashcard_details(text, count):
+    """Validates the batched flashcard reply; returns count normalized dicts, or None if malformed."""
+    details = json.loads(text)
+    if not isinstance(details, list) or len(details) != count:
+        return None
+    
+    parsed = []
+    for detail in details:
+        if not isinstance(detail, dict):
+            return None
+        definition = detail.get("definition")
+        in_other_words = detail.get("in_other_words")
+        examples = detail.get("examples")
+        if not isinstance(definition, (str, type(None))) or not isinstance(in_other_words, (str, type(None))):
+            return None
+        # A lone example sometimes comes back as a plain string
+        if isinstance(examples, str):
+            examples = [examples]
+        elif isinstance(examples, list):
+            examples = [str(example) for example in examples if isinstance(example, (str, int, float))]
+        elif examples is not None:
+            return None
+        parsed.append({"definition": definition, "in_other_words": in_other_words, "examples": examples})
+    return parsed
+
+def run_glossary_flashcards(prompt, message_placeholder, command_message=""):
+    """Serves /weeklyhgflashcards definitions from hug_fc.txt and asks the model only for the rest.
+
+    Returns None if the model's batched reply can't be parsed, so the caller can fall back.
+    """
+    terms = parse_term_list(prompt)
+    if not terms:
+        return None
+    
+    glossary = get_glossary_index()
+    cards = []
+    for term in terms:
+        match = glossary.lookup(term)
+        if match:
+            # A fuzzy match keeps the student's wording, so a near miss is visible on the card
+            card_term = term if match[2] == "fuzzy" else match[0]
+            cards.append({"term": card_term, "definition": match[1], "known": True})
         else:
-            full_response += chunk
-        time.sleep(0.02)
-        message_placeholder.markdown(full_response + "▌", unsafe_allow_html=True)
+            cards.append({"term": term, "definition": None, "known": False})
     
-    # Display final response without cursor
+    # Canonical definitions are shown immediately while the model fills in the rest
+    prefix = f"{command_message}\n\n" if command_message else ""
+    preview = "\n\n".join(format_flashcard(card["term"], card["definition"] or "...") for card in cards)
+    message_placeholder.markdown(f"{prefix}{preview}▌", unsafe_allow_html=True)
+    
+    request = [
+        {"term": card["term"], "needs_definition": not card["known"]}
+        for card in cards
+    ]
+    batch_prompt = (
+        "For each AP Human Geography term below, return a JSON array with one object per term, "
+        'in the same order, with keys "term", "in_other_words" (a rephrasing/restatement of the term), '
+        '"examples" (a list of 2-5 short examples) and "definition" (only when needs_definition is true, '
+        "otherwise null).\n\n" + json.dumps(request)
+    )
+    response = run_model_request(
+        lambda model: model.generate_content(
+            batch_prompt,
+            generation_config={**generation_config, "response_mime_type": "application/json"}
+        ),
+        st.session_state.session_id
+    )
+    try:
+        details = parse_flashcard_details(response.text, len(cards))
+    except ValueError:
+        return None
+    if details is None:
+        return None
+    
+    formatted = []
+    for card, detail in zip(cards, details):
+        definition = card["definition"] or detail["definition"] or ""
+        formatted.append(format_flashcard(
+            card["term"],
+            definition,
+            detail["in_other_words"],
+            detail["examples"]
+        ))
+    
+    full_response = prefix + "\n\n".join(formatted)
     message_placeholder.markdown(full_response, unsafe_allow_html=True)
+    append_history_exchange(f"/weeklyhgflashcards\n{prompt}", full_response)
     return full_response
-    
+
 def show_file_preview(uploaded_file):
     mime_type = detect_file_type(uploaded_file)
     
@@ -870,23 +3408,119 @@ def show_file_preview(uploaded_file):
     else:
         st.sidebar.info(f"Uploaded: {uploaded_file.name} (Type: {mime_type})")
 
-def prepare_chat_input(prompt, files):
+# Commands that only need an attachment's words, not its layout or pictures
+TEXT_ONLY_COMMANDS = {
+    "/wordcount", "/summarize", "/check4grammar", "/paraphrase", "/synonyms",
+    "/translation", "/litanalysis", "/cornellformat", "/essayoutline",
+}
+# Formats Gemini can't read natively, so extracted text is the only useful payload
+TEXT_NATIVE_TYPES = {
+    'application/msword',
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    'text/csv', XLSX_MIME_TYPE, 'application/json', 'application/xml', 'text/plain',
+}
+# Share of extracted words that must look like real words before the text is trusted alone
+PAYLOAD_MIN_CONFIDENCE = 0.6
+# Past this many estimated tokens a PDF is cheaper to send as a document than as text
+PAYLOAD_MAX_TEXT_TOKENS = 30000
+# PDFs with more bytes per extracted character than this likely carry figures worth sending too
+PAYLOAD_VISUAL_BYTES_PER_CHAR = 40
+WORDLIKE_PATTERN = re.compile(r'^[\W_]*(?:[^\W\d_]{2,}|\d+(?:[.,]\d+)*)[\W_]*$')
+ATTACHMENT_TEXT_HEADER = "Content of attachment {name}:\n"
+ATTACHMENT_TEXT_PATTERN = re.compile(r'^Content of attachment (.+?):\n')
+
+def extract_attachment_text(data, mime_type, pdf_pages=None, cache=None):
+    if mime_type.startswith('application/pdf'):
+        return cached_extract(data, "pdf", extract_pdf_text, pdf_pages, params=pdf_pages or "", cache=cache)
+    if mime_type in ['application/msword', 'application/vnd.openxmlformats-officedocument.wordprocessingml.document']:
+        return cached_extract(data, "docx", extract_docx_text, cache=cache)
+    if mime_type.startswith('image/'):
+        return cached_extract(data, "image", extract_image_text, cache=cache)
+    if mime_type in ['text/csv', XLSX_MIME_TYPE, 'application/json', 'application/xml', 'text/plain']:
+        return cached_extract(data, "structured", process_structured_data, mime_type, params=mime_type, cache=cache)
+    return None
+
+def extraction_confidence(text):
+    words = text.split()
+    if not words:
+        return 0.0
+    return sum(1 for word in words if WORDLIKE_PATTERN.match(word)) / len(words)
+
+def plan_attachment(mime_type, size, text, active_command):
+    """Decides whether an attachment goes to the model as "text", "media" or "both".
+
+    Returns (mode, reason).
+    """
+    if not text or text.startswith("Error "):
+        return "media", "no extracted text"
+    if mime_type in TEXT_NATIVE_TYPES:
+        return "text", "format is read as text"
+    
+    confidence = extraction_confidence(text)
+    if confidence < PAYLOAD_MIN_CONFIDENCE:
+        return "media", f"low extraction confidence ({confidence:.2f})"
+    if active_command in TEXT_ONLY_COMMANDS:
+        return "text", f"{active_command} only needs the text"
+    if mime_type.startswith('image/'):
+        return "media", "images keep their visual content"
+    
+    tokens = len(text) // 4 + 1
+    if tokens > PAYLOAD_MAX_TEXT_TOKENS:
+        return "media", f"~{tokens} text tokens"
+    if size / len(text) > PAYLOAD_VISUAL_BYTES_PER_CHAR:
+        return "both", "document likely contains figures"
+    return "text", f"~{tokens} text tokens"
+
+def attachment_text_part(name, text):
+    # The fixed header lets strip_answered_attachments find these parts in answered turns
+    return f"{ATTACHMENT_TEXT_HEADER.format(name=name)}{text}"
+
+def prepare_planned_attachment(data, mime_type, display_name, active_command, pdf_pages,
+                               registry, extraction_cache, image_cache, compress_images, trace=None):
+    """Extracts, plans and prepares one attachment; runs on a preprocessing worker.
+
+    Returns (mode, reason, media_part, text_part), with None for whichever part the plan leaves out.
+    """
+    text = None
+    # OCR is only worth its cost when the text could replace the image
+    if not mime_type.startswith('image/') or active_command in TEXT_ONLY_COMMANDS:
+        start = time.perf_counter()
+        try:
+            text = extract_attachment_text(data, mime_type, pdf_pages, extraction_cache)
+        except Exception as e:
+            logger.warning("Extraction of %s failed: %s", display_name, e)
+        if trace is not None:
+            trace.record("extraction", start, time.perf_counter() - start, attachment=display_name)
+    
+    mode, reason = plan_attachment(mime_type, len(data), text, active_command)
+    media_part = text_part = None
+    if mode in ("media", "both"):
+        media_part = prepare_attachment_part(data, mime_type, display_name, registry, compress_images, image_cache)
+    if mode in ("text", "both"):
+        text_part = attachment_text_part(display_name, text)
+    return mode, reason, media_part, text_part
+
+def pdf_pages_setting():
+    """Returns the sidebar's PDF page range, or None (all pages) with a warning if it doesn't parse."""
+    spec = st.session_state.get('pdf_pages')
+    if not spec or not spec.strip():
+        return None
+    try:
+        # Only the syntax is checked here; each PDF's page count isn't known yet
+        parse_page_ranges(spec, 9999)
+    except ValueError:
+        st.warning(f'"{spec}" isn\'t a valid page range (e.g. 1-3, 7), so all PDF pages were read.')
+        return None
+    return spec
+
+def prepare_chat_input(prompt, files, pdf_pages=None):
     input_parts = []
     
     for file in files:
         mime_type = detect_file_type(file)
-        content = None
         
         try:
-            if mime_type.startswith('application/pdf'):
-                content = extract_pdf_text(file)
-            elif mime_type in ['application/msword', 'application/vnd.openxmlformats-officedocument.wordprocessingml.document']:
-                content = extract_docx_text(file)
-            elif mime_type.startswith('image/'):
-                content = extract_image_text(file)
-            elif mime_type in ['text/csv', 'application/json', 'application/xml', 'text/plain']:
-                content = process_structured_data(file, mime_type)
-            
+            content = extract_attachment_text(file.getvalue(), mime_type, pdf_pages)
             if content:
                 input_parts.append({
                     'type': mime_type,
@@ -900,6 +3534,104 @@ def prepare_chat_input(prompt, files):
     input_parts.append(prompt)
     return input_parts
 
+# Messages shown per page of the transcript; older ones sit behind "Load earlier messages"
+TRANSCRIPT_WINDOW = 30
+
+@st.fragment
+def render_prebuilt_commands():
+    # Runs as a fragment so toggling commands doesn't rerun the whole app and repaint the transcript
+    if 'current_command' not in st.session_state:
+        st.session_state.current_command = None
+        
+    st.write("**Active:**", st.session_state.current_command if st.session_state.current_command else "None")
+    
+    for cmd, info in PREBUILT_COMMANDS.items():
+        col1, col2 = st.columns([4, 1])
+        
+        with col1:
+            button_active = st.session_state.current_command == cmd
+            if st.button(
+                info["title"],
+                key=f"cmd_{cmd}",
+                type="primary" if button_active else "secondary"
+            ):
+                if st.session_state.current_command == cmd:
+                    st.session_state.current_command = None
+                else:
+                    st.session_state.current_command = cmd
+                st.rerun(scope="fragment")
+        
+        with col2:
+            help_key = f"help_{cmd}"
+            if help_key not in st.session_state:
+                st.session_state[help_key] = False
+            
+            button_text = "×" if st.session_state[help_key] else "?"
+            if st.button(button_text, key=f"help_btn_{cmd}"):
+                st.session_state[help_key] = not st.session_state[help_key]
+                st.rerun(scope="fragment")
+        
+        if st.session_state[help_key]:
+            st.info(info["description"])
+
+@st.fragment
+def render_diagnostics():
+    collector = get_trace_collector()
+    if st.button("Refresh", key="refresh_diagnostics"):
+        st.rerun(scope="fragment")
+    
+    summary = collector.percentiles()
+    if summary:
+        rows = ["| Span | Count | p50 ms | p95 ms | p99 ms |", "|---|---|---|---|---|"]
+        for name, stats in sorted(summary.items()):
+            rows.append(f"| {name} | {stats['count']} | {stats['p50']:.0f} | {stats['p95']:.0f} | {stats['p99']:.0f} |")
+        st.markdown("\n".join(rows))
+    else:
+        st.caption("No turns traced yet.")
+    
+    recent = collector.recent(st.session_state.session_id, limit=1)
+    if recent:
+        trace = recent[-1]
+        st.caption(f"Last turn: trace {trace['trace_id']}, {trace['status']}, {trace['duration_ms']:.0f} ms")
+        rows = ["| Span | Start ms | Duration ms |", "|---|---|---|"]
+        for span in sorted(trace["spans"], key=lambda span: span["start_ms"]):
+            label = span["name"]
+            if "attachment" in span.get("attributes", {}):
+                label += f" ({span['attributes']['attachment']})"
+            rows.append(f"| {label} | {span['start_ms']:.0f} | {span['duration_ms']:.0f} |")
+        st.markdown("\n".join(rows))
+    
+    st.download_button(
+        "Download traces (JSONL)",
+        collector.export_jsonl(),
+        file_name="mainframe_traces.jsonl",
+        mime="application/jsonl"
+    )
+    st.download_button(
+        "Download metrics (Prometheus)",
+        prometheus_metrics(collector, current_component_stats()),
+        file_name="mainframe_metrics.prom",
+        mime="text/plain"
+    )
+
+@st.fragment
+def render_transcript():
+    # Messages are stored already formatted (process_response runs once when the answer
+    # finishes streaming), so each rerun only re-emits the visible window.
+    if 'transcript_window' not in st.session_state:
+        st.session_state.transcript_window = TRANSCRIPT_WINDOW
+    
+    messages = st.session_state.messages
+    hidden = max(0, len(messages) - st.session_state.transcript_window)
+    if hidden:
+        if st.button(f"Load earlier messages ({hidden} hidden)", key="load_earlier_messages"):
+            st.session_state.transcript_window += TRANSCRIPT_WINDOW
+            st.rerun(scope="fragment")
+    
+    for message in messages[hidden:]:
+        with st.chat_message(message["role"]):
+            st.markdown(message["content"], unsafe_allow_html=True)
+
 def main():
     # Check password first
     if not check_password():
@@ -980,6 +3712,21 @@ def main():
                 }
                 save_accessibility_preferences()
                 st.rerun()
+            
+            st.markdown("---")
+            st.checkbox(
+                "Reuse cached answers",
+                value=st.session_state.get('use_response_cache', True),
+                key="use_response_cache",
+                help="Identical opening requests of a new chat are answered instantly from a shared cache"
+            )
+            cache_stats = get_response_cache().stats
+            st.caption(f"Answer cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses")
+            pool_stats = get_model_pool().stats()
+            st.caption(
+                f"Model pool: {pool_stats['in_use']}/{pool_stats['size']} in use, "
+                f"peak {pool_stats['peak_in_use']}, {pool_stats['leases']} requests"
+            )
 
     # File Upload Section
     with st.sidebar:
@@ -1013,6 +3760,19 @@ def main():
                     st.warning(f"Files exceeding 20MB limit: {', '.join(oversized_files)}")
                 
                 st.session_state.uploaded_files = valid_files
+            
+            st.text_input(
+                "PDF pages",
+                key="pdf_pages",
+                placeholder="All pages, or e.g. 1-3, 7",
+                help="Only these pages of uploaded PDFs are read"
+            )
+            st.checkbox(
+                "Send original images",
+                value=st.session_state.get('keep_original_images', False),
+                key="keep_original_images",
+                help="Skips resizing and re-encoding of photos and pasted images (slower uploads)"
+            )
 
     # Camera Input Section
     with st.sidebar:
@@ -1038,93 +3798,86 @@ def main():
     # Prebuilt Commands Section
     with st.sidebar:
         with st.expander("**Prebuilt Commands**", expanded=False):
-            if 'current_command' not in st.session_state:
-                st.session_state.current_command = None
-                
-            st.write("**Active:**", st.session_state.current_command if st.session_state.current_command else "None")
-            
-            for cmd, info in PREBUILT_COMMANDS.items():
-                col1, col2 = st.columns([4, 1])
-                
-                with col1:
-                    button_active = st.session_state.current_command == cmd
-                    if st.button(
-                        info["title"],
-                        key=f"cmd_{cmd}",
-                        type="primary" if button_active else "secondary"
-                    ):
-                        if st.session_state.current_command == cmd:
-                            st.session_state.current_command = None
-                        else:
-                            st.session_state.current_command = cmd
-                        st.rerun()
-                
-                with col2:
-                    help_key = f"help_{cmd}"
-                    if help_key not in st.session_state:
-                        st.session_state[help_key] = False
-                    
-                    button_text = "×" if st.session_state[help_key] else "?"
-                    if st.button(button_text, key=f"help_btn_{cmd}"):
-                        st.session_state[help_key] = not st.session_state[help_key]
-                        st.rerun()
-                
-                if st.session_state[help_key]:
-                    st.info(info["description"])
+            render_prebuilt_commands()
+
+    # Diagnostics Section (admins only)
+    if st.session_state.get('is_admin'):
+        with st.sidebar:
+            with st.expander("**Diagnostics**", expanded=False):
+                render_diagnostics()
 
     # Display messages
-    for message in st.session_state.messages:
-        with st.chat_message(message["role"]):
-            st.markdown(message["content"], unsafe_allow_html=True)
+    render_transcript()
 
     # Handle audio input
     if audio_input is not None:
         audio_hash = get_audio_hash(audio_input)
         
         if audio_hash not in st.session_state.processed_audio_hashes:
+            trace = TurnTrace(st.session_state.session_id, kind="voice")
             try:
-                audio_file = save_audio_file(audio_input)
                 st.audio(audio_input, format='audio/wav')
-                
+                st.info("Converting speech to text...")
+                # Transcription runs alongside the extraction and upload of any attachments, and
+                # has its own span, so prompt_assembly covers the same work as in a typed turn
+                transcription = start_transcription(audio_input, trace)
+                with trace.span("prompt_assembly"):
+                    input_parts, attachment_errors = preprocess_attachments(
+                        st.session_state.uploaded_files,
+                        st.session_state.camera_image,
+                        trace,
+                        pdf_pages=pdf_pages_setting()
+                    )
+                for error in attachment_errors:
+                    st.warning(error)
                 try:
-                    st.info("Converting speech to text...")
-                    transcribed_text = convert_audio_to_text(audio_file)
-                    
-                    st.success("Speech converted to text!")
-                    st.text(f"Transcribed text: {transcribed_text}")
-                    
-                    st.chat_message("user").markdown(transcribed_text)
-                    st.session_state.messages.append({"role": "user", "content": transcribed_text})
-                    
-                    with st.chat_message("assistant"):
-                        message_placeholder = st.empty()
-                        response = st.session_state.chat_session.send_message(transcribed_text)
-                        full_response = handle_chat_response(response, message_placeholder)
-                        
-                        st.session_state.messages.append({
-                            "role": "assistant", 
-                            "content": full_response
-                        })
-                    
-                    st.session_state.processed_audio_hashes.add(audio_hash)
+                    transcribed_text = transcription.result(AUDIO_TRANSCRIPTION_TIMEOUT)
+                except FuturesTimeoutError:
+                    raise Exception("Speech recognition took too long")
+                
+                st.success("Speech converted to text!")
+                st.text(f"Transcribed text: {transcribed_text}")
+                
+                st.chat_message("user").markdown(transcribed_text)
+                st.session_state.messages.append({"role": "user", "content": transcribed_text})
+                input_parts.append(transcribed_text)
+                
+                with st.chat_message("assistant"):
+                    message_placeholder = st.empty()
+                    with trace.span("history_compaction"):
+                        compact_chat_history(st.session_state.chat_session)
+                    full_response = stream_chat_reply(input_parts, message_placeholder, trace=trace)
                     
-                finally:
-                    os.unlink(audio_file)
+                    st.session_state.messages.append({
+                        "role": "assistant", 
+                        "content": full_response
+                    })
+                
+                st.session_state.processed_audio_hashes.add(audio_hash)
                     
             except Exception as e:
+                trace.status = "error"
                 st.error(f"An error occurred while processing the audio: {str(e)}")
                 st.warning("Please try again or type your question instead.")
+            finally:
+                finish_turn_trace(trace)
 
     # Chat input handling
     prompt = st.chat_input("What can I help you with?")
 
     if prompt:
+        trace = TurnTrace(st.session_state.session_id)
+        assembly_started = time.perf_counter()
         final_prompt = prompt
+        command_prompt = ""
         command_suffix = ""
         command_message = ""
         
+        active_command = None
+        
         if hasattr(st.session_state, 'current_command') and st.session_state.current_command:
             command = st.session_state.current_command
+            active_command = command
             
             # Check if it's a built-in command or custom command
             if command in PREBUILT_COMMANDS:
@@ -1139,22 +3892,34 @@ def main():
             final_prompt = f"{command_prompt}\n{prompt}"
             st.session_state.current_command = None
 
-        input_parts = []
-        
-        if st.session_state.uploaded_files:
-            for file in st.session_state.uploaded_files:
-                input_parts.append({
-                    'mime_type': detect_file_type(file),
-                    'data': file.getvalue()
-                })
+        pdf_pages = pdf_pages_setting()
+        # The cache is checked first so a hit skips extraction, compression and uploads entirely
+        cache_key = None
+        cached_answer = None
+        if response_cache_allowed():
+            file_hashes = [hashlib.sha256(file.getvalue()).hexdigest() for file in st.session_state.uploaded_files]
+            if st.session_state.camera_image:
+                file_hashes.append(hashlib.sha256(st.session_state.camera_image.getvalue()).hexdigest())
+            cache_key = response_cache_key(
+                command_prompt, prompt, file_hashes, pdf_pages,
+                st.session_state.get('keep_original_images', False)
+            )
+            cached_answer = get_response_cache().get(cache_key)
         
-        if st.session_state.camera_image:
-            input_parts.append({
-                'mime_type': 'image/jpeg',
-                'data': st.session_state.camera_image.getvalue()
-            })
+        input_parts, attachment_errors = [], []
+        if cached_answer is None:
+            input_parts, attachment_errors = preprocess_attachments(
+                st.session_state.uploaded_files,
+                st.session_state.camera_image,
+                trace=trace,
+                active_command=active_command,
+                pdf_pages=pdf_pages
+            )
+            for error in attachment_errors:
+                st.warning(error)
 
         input_parts.append(final_prompt)
+        trace.record("prompt_assembly", assembly_started, time.perf_counter() - assembly_started)
 
         st.chat_message("user").markdown(prompt + command_suffix)
         st.session_state.messages.append({"role": "user", "content": prompt + command_suffix})
@@ -1163,8 +3928,40 @@ def main():
             message_placeholder = st.empty()
             
             try:
-                response = st.session_state.chat_session.send_message(input_parts)
-                full_response = handle_chat_response(response, message_placeholder, command_message)
+                full_response = None
+                if cached_answer is not None:
+                    # Only the plain chat path stores answers, so a hit stands in for that path
+                    with trace.span("cached_answer"):
+                        full_response = f"{command_message}\n\n{cached_answer}" if command_message else cached_answer
+                        message_placeholder.markdown(full_response, unsafe_allow_html=True)
+                        append_history_exchange(final_prompt, cached_answer)
+                
+                long_input = None
+                if full_response is None and active_command in MAP_REDUCE_COMMANDS:
+                    long_input = collect_long_input(prompt, st.session_state.uploaded_files, pdf_pages)
+                
+                if long_input:
+                    with trace.span("history_compaction"):
+                        compact_chat_history(st.session_state.chat_session)
+                    with trace.span("map_reduce"):
+                        full_response = run_map_reduce(active_command, long_input, prompt, message_placeholder, command_message)
+                elif (full_response is None
+                        and active_command == "/weeklyhgflashcards"
+                        and not st.session_state.uploaded_files
+                        and not st.session_state.camera_image):
+                    with trace.span("history_compaction"):
+                        compact_chat_history(st.session_state.chat_session)
+                    with trace.span("glossary"):
+                        full_response = run_glossary_flashcards(prompt, message_placeholder, command_message)
+                
+                if full_response is None:
+                    with trace.span("history_compaction"):
+                        compact_chat_history(st.session_state.chat_session)
+                    full_response = stream_chat_reply(input_parts, message_placeholder, command_message, trace)
+                    # An answer given without some of the attachments mustn't be served to turns that have them all
+                    if cache_key is not None and not attachment_errors:
+                        answer = full_response[len(command_message) + 2:] if command_message else full_response
+                        get_response_cache().put(cache_key, answer)
                 
                 st.session_state.messages.append({
                     "role": "assistant", 
@@ -1172,11 +3969,14 @@ def main():
                 })
                 
             except Exception as e:
+                trace.status = "error"
                 st.error(f"An error occurred: {str(e)}")
-                if "rate_limit" in str(e).lower():
+                if is_rate_limit_error(e):
                     st.warning("The API rate limit has been reached. Please wait a moment before trying again.")
                 else:
                     st.warning("Please try again in a moment.")
+            finally:
+                finish_turn_trace(trace)
 
         if st.session_state.camera_image and not st.session_state.camera_enabled:
             st.session_state.camera_image = None